@@ -1,111 +1,293 @@
 import json
 import re
+from collections import defaultdict
+from typing import List
 
-from . import db, utils
+from redis.commands.search.commands import SUGADD_COMMAND
 
+from . import db, stats, utils
 
-def load_appstream():
-    apps = utils.appstream2dict("repo")
+# Validators of the last appstream loaded, see utils.open_appstream()
+SOURCE_KEY = "sources:appstream"
 
-    current_apps = {app[5:] for app in db.redis_conn.smembers("apps:index")}
-    current_categories = db.redis_conn.smembers("categories:index")
-    current_developers = db.redis_conn.smembers("developers:index")
+CLEAN_HTML_RE = re.compile("<.*?>")
+
+
+def _copy_memberships(p, generation, index_name: str, prefix: str):
+    generation.copy_set(p, index_name)
+    for name in db.redis_conn.smembers(generation.previous_key(index_name)):
+        generation.copy_set(p, f"{prefix}:{name}")
+
+
+def _write_memberships(p, generation, index_name: str, prefix: str, memberships):
+    if memberships:
+        p.sadd(generation.key(index_name), *memberships)
+    for name, redis_keys in memberships.items():
+        p.sadd(generation.key(f"{prefix}:{name}"), *redis_keys)
+
+
+def load_appstream(generation: db.Generation, force: bool = False):
+    """
+    Load the repo's appstream into Redis
+
+    When the source is unchanged since the last successful load, the app,
+    category and developer indexes are carried over to the new generation
+    and None is returned, otherwise the set of new apps.
+
+    Documents are only stored for apps whose content hash changed since the
+    previous generation, so the work done scales with the number of changed
+    apps. The search index is written by update_search_index().
+    """
+    validators = None if force else db.get_json_key(SOURCE_KEY)
+    file, new_validators = utils.open_appstream("repo", validators)
+    if file is None:
+        with db.BatchWriter("appstream") as p:
+            generation.copy_set(p, "apps:index")
+            _copy_memberships(p, generation, "categories:index", "categories")
+            _copy_memberships(p, generation, "developers:index", "developers")
+            if new_validators != validators:
+                generation.set_on_publish(SOURCE_KEY, json.dumps(new_validators))
+        return None
+
+    current_apps = {
+        app[5:] for app in db.redis_conn.smembers(generation.previous_key("apps:index"))
+    }
 
     db.initialize()
-    with db.redis_conn.pipeline() as p:
-        p.delete("categories:index", *current_categories)
-        p.delete("developers:index", *current_developers)
 
-        for appid in apps:
+    # Only the index memberships are kept around, documents are written out
+    # in batches as they are parsed
+    apps = set()
+    categories = defaultdict(set)
+    developers = defaultdict(set)
+
+    with db.BatchWriter("appstream") as p:
+        for appid, app in utils.iter_components(file):
             redis_key = f"apps:{appid}"
+            apps.add(appid)
 
-            clean_html_re = re.compile("<.*?>")
-            search_description = re.sub(clean_html_re, "", apps[appid]["description"])
-
-            if search_keywords := apps[appid].get("keywords"):
-                search_keywords = " ".join(search_keywords)
-            else:
-                search_keywords = ""
-
-            fts = {
-                "id": appid,
-                "name": apps[appid]["name"],
-                "summary": apps[appid]["summary"],
-                "description": search_description,
-                "keywords": search_keywords,
-            }
-
-            if developer_name := apps[appid].get("developer_name"):
-                p.sadd("developers:index", developer_name)
-                p.sadd(f"developers:{developer_name}", redis_key)
-
-            p.set(f"apps:{appid}", json.dumps(apps[appid]))
-            p.hset(f"fts:{appid}", mapping=fts)
-
-            if categories := apps[appid].get("categories"):
-                for category in categories:
-                    p.sadd("categories:index", category)
-                    p.sadd(f"categories:{category}", redis_key)
-
-        for appid in current_apps - set(apps):
-            p.delete(
-                f"apps:{appid}",
-                f"fts:{appid}",
-                f"summary:{appid}",
-                f"app_stats:{appid}",
-            )
-            db.redis_conn.ft().delete_document(f"fts:{appid}")
+            if developer_name := app.get("developer_name"):
+                developers[developer_name].add(redis_key)
+
+            if app_categories := app.get("categories"):
+                for category in app_categories:
+                    categories[category].add(redis_key)
 
-        new_apps = set(apps) - current_apps
-        if not len(new_apps):
-            new_apps = None
+            generation.set_document(p, redis_key, json.dumps(app))
 
-        p.delete("apps:index")
-        p.sadd("apps:index", *[f"apps:{appid}" for appid in apps])
-        p.execute()
+        _write_memberships(p, generation, "categories:index", "categories", categories)
+        _write_memberships(p, generation, "developers:index", "developers", developers)
+        if apps:
+            p.sadd(generation.key("apps:index"), *[f"apps:{appid}" for appid in apps])
 
-    return new_apps
+    for appid in current_apps - apps:
+        generation.delete_document(f"apps:{appid}")
+        generation.delete_document(f"summary:{appid}")
+        generation.delete_document(f"app_stats:{appid}")
+        generation.delete_on_publish(
+            *[
+                f"app_stats_series:{appid}:{resolution}"
+                for resolution in stats.SERIES_RESOLUTIONS
+            ]
+        )
 
+    generation.set_on_publish(SOURCE_KEY, json.dumps(new_validators))
 
+    return apps - current_apps
+
+
+@db.cached
 def list_appstream():
-    apps = {app[5:] for app in db.redis_conn.smembers("apps:index")}
+    apps = {app[5:] for app in db.redis_conn.smembers(db.catalogue_key("apps:index"))}
     return sorted(apps)
 
 
+@db.cached
 def get_recently_updated(limit: int = 100):
-    zset = db.redis_conn.zrevrange("recently_updated_zset", 0, limit - 1)
-    return [appid for appid in zset if db.redis_conn.exists(f"apps:{appid}")]
+    zset = db.redis_conn.zrevrange(
+        db.catalogue_key("recently_updated_zset"), 0, limit - 1
+    )
+    if not zset:
+        return []
 
+    digests = db.redis_conn.hmget(
+        db.catalogue_key(db.DOCUMENTS_KEY), [f"apps:{appid}" for appid in zset]
+    )
+    return [appid for appid, digest in zip(zset, digests) if digest is not None]
 
-def get_category(category: str):
-    if index := db.redis_conn.smembers(f"categories:{category}"):
-        return [appid.removeprefix("apps:") for appid in index]
-    else:
-        return []
 
+def _add_suggestion(suggestions: dict, string: str, weight: float, appid: str):
+    # Names shared by several apps complete to the most downloaded one
+    key = string.casefold()
+    if key not in suggestions or suggestions[key][1] < weight:
+        suggestions[key] = (string, weight, appid)
+
+
+def update_suggestions(generation: db.Generation):
+    """
+    Build the generation's autocomplete dictionary from the app names, ids
+    and keywords in the search index, weighted by last month's downloads
+    """
+    appids = [
+        redis_key.removeprefix("apps:")
+        for redis_key in db.redis_conn.smembers(generation.key("apps:index"))
+    ]
+    downloads = dict(
+        db.redis_conn.zrange(
+            generation.key(stats.DOWNLOADS_ZSET_KEY), 0, -1, withscores=True
+        )
+    )
+
+    appids = [appid for appid in appids if f"fts:{appid}" in generation.documents]
+    with db.redis_conn.pipeline(transaction=False) as p:
+        for appid in appids:
+            digest = generation.documents[f"fts:{appid}"]
+            p.hmget(db.get_document_key(f"fts:{appid}", digest), "name", "keywords")
+        fields = p.execute()
+
+    suggestions = {}
+    keywords = defaultdict(float)
+    for appid, (name, app_keywords) in zip(appids, fields):
+        # Apps without downloads still need a positive score
+        weight = downloads.get(f"apps:{appid}", 0) + 1
+
+        _add_suggestion(suggestions, appid, weight, appid)
+        if name:
+            _add_suggestion(suggestions, name, weight, appid)
+
+        for keyword in (app_keywords or "").split():
+            keywords[keyword.casefold()] += weight
 
-def get_developer(developer: str):
-    if index := db.redis_conn.smembers(f"developers:{developer}"):
-        return [appid.removeprefix("apps:") for appid in index]
+    # Keywords rank by the downloads of all apps they describe, and don't
+    # point at any single one of them
+    for keyword, weight in keywords.items():
+        suggestions.setdefault(keyword, (keyword, weight, None))
+
+    with db.BatchWriter("suggestions") as p:
+        for string, weight, appid in suggestions.values():
+            args = [SUGADD_COMMAND, generation.key(db.SUGGESTIONS_KEY), string, weight]
+            if appid:
+                args += ["PAYLOAD", appid]
+            p.execute_command(*args)
+
+
+def get_downloads_bucket(downloads: int) -> int:
+    """
+    Round downloads down to 1, 2 or 5 times a power of ten
+
+    Monthly downloads change for almost every app every day, while the bucket
+    rarely does, so this is what the fts: hashes store.
+    """
+    if downloads < 1:
+        return 0
+
+    magnitude = 10 ** (len(str(int(downloads))) - 1)
+    for step in (5, 2, 1):
+        if downloads >= step * magnitude:
+            return step * magnitude
+
+
+def _get_search_fields(appid: str, app: dict) -> dict:
+    if keywords := app.get("keywords"):
+        keywords = " ".join(keywords)
     else:
-        return []
+        keywords = ""
+
+    fields = {
+        "id": appid,
+        "name": app["name"],
+        "summary": app["summary"],
+        "description": re.sub(CLEAN_HTML_RE, "", app["description"]),
+        "keywords": keywords,
+    }
+
+    # Returned with search results and used as filters rather than searched
+    # as text, see db.initialize()
+    optional = {
+        "icon": app.get("icon"),
+        "categories": ",".join(app.get("categories") or []),
+        "developer_name": app.get("developer_name"),
+        "project_license": app.get("project_license"),
+    }
+    fields.update({field: value for field, value in optional.items() if value})
+
+    return fields
+
+
+def update_search_index(generation: db.Generation):
+    """
+    Store the generation's fts: hashes, made of the apps' appstream and of
+    the summary, download and verification data searches can be filtered by
+
+    An app's hash is only stored again when its appstream document or one of
+    those values changed, as RediSearch reindexes an app whenever a hash is
+    written.
+    """
+    appids = [
+        redis_key.removeprefix("apps:")
+        for redis_key in db.redis_conn.smembers(generation.key("apps:index"))
+    ]
+
+    downloads = dict(
+        db.redis_conn.zrange(
+            generation.key(stats.DOWNLOADS_ZSET_KEY), 0, -1, withscores=True
+        )
+    )
+    verified = db.redis_conn.smembers("verification:verified")
+    summaries = generation.get_json_documents([f"summary:{appid}" for appid in appids])
+
+    changed = {}
+    for appid, summary in zip(appids, summaries):
+        summary = summary or {}
+        values = {
+            "arches": ",".join(summary.get("arches", [])),
+            "installed_size": summary.get("installed_size"),
+            "updated": summary.get("timestamp"),
+            "downloads_last_month": get_downloads_bucket(
+                downloads.get(f"apps:{appid}", 0)
+            ),
+            "verified": "true" if appid in verified else "false",
+        }
+        values = {
+            field: value for field, value in values.items() if value not in (None, "")
+        }
+
+        hasher = utils.Hasher()
+        hasher.add_string(generation.documents.get(f"apps:{appid}", ""))
+        hasher.add_string(json.dumps(values, sort_keys=True))
+        digest = hasher.hash()
+
+        if generation.documents.get(f"fts:{appid}") != digest:
+            changed[appid] = (digest, values)
+
+    documents = generation.get_json_documents([f"apps:{appid}" for appid in changed])
+
+    with db.BatchWriter("search index") as p:
+        for (appid, (digest, values)), app in zip(changed.items(), documents):
+            if app is None:
+                continue
+
+            generation.set_search_document(
+                p, f"fts:{appid}", digest, {**_get_search_fields(appid, app), **values}
+            )
 
+        catalogue = {f"fts:{appid}" for appid in appids}
+        for key in [key for key in generation.documents if key.startswith("fts:")]:
+            if key not in catalogue:
+                generation.delete_search_document(p, key)
 
-def search(query: str):
-    if results := db.search(query):
-        appids = tuple(doc_id.replace("fts", "apps") for doc_id in results)
-        apps = [json.loads(x) for x in db.redis_conn.mget(appids)]
 
-        ret = []
-        for app in apps:
-            entry = {
-                "id": app["id"],
-                "name": app["name"],
-                "summary": app["summary"],
-                "icon": app.get("icon"),
-            }
-            ret.append(entry)
+def search(
+    query: str,
+    offset: int = 0,
+    limit: int = db.SEARCH_DEFAULT_LIMIT,
+    filters: dict = None,
+    facets: List[str] = (),
+):
+    total, hits, facet_counts = db.search(query, offset, limit, filters, facets)
 
-        return ret
+    result = {"hits": hits, "total": total}
+    if facets:
+        result["facets"] = facet_counts
 
-    return []
+    return result
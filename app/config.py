@@ -15,8 +15,11 @@ class Settings(BaseSettings):
     database_url: str = "postgresql+psycopg2://postgres:postgres@db:5432"
     sentry_dsn: Optional[str] = None
     appstream_repos: Optional[str] = None
+    appstream_parse_processes: int = 1
     datadir: str = os.path.join(ROOT_DIR, "data")
     stats_baseurl = "https://flathub.org/stats"
+    stats_fetch_concurrency: int = 8
+    stats_cache_dir: str = os.path.join(ROOT_DIR, "cache", "stats")
     enable_login_support: bool = False
     session_secret_key: str = "change-me-for-production"
     database_url: str = "postgresql+psycopg2://postgres:postgres@db:5432"
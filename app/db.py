@@ -1,12 +1,95 @@
+import contextlib
+import functools
+import gzip
 import json
+import logging
+import re
+import threading
 import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
+import brotli
 import redis
-from redis.commands.search.field import TextField
+from redis.commands.search import reducers
+from redis.commands.search.aggregation import AggregateRequest, Desc
+from redis.commands.search.commands import AGGREGATE_CMD, SEARCH_CMD
+from redis.commands.search.document import Document
+from redis.commands.search.field import NumericField, TagField, TextField
 from redis.commands.search.indexDefinition import IndexDefinition
 from redis.commands.search.query import Query
+from redis.commands.search.result import Result
 
-from . import config
+from . import config, utils
+
+logger = logging.getLogger(__name__)
+
+# Number of the published catalogue generation
+GENERATION_KEY = "catalogue:generation"
+# Generations which may still have keys in Redis
+GENERATIONS_KEY = "catalogue:generations"
+GENERATION_COUNTER_KEY = "catalogue:next_generation"
+# How long the published generation is cached by readers
+GENERATION_CACHE_SECONDS = 1.0
+
+# Size of the in-process cache of hot lookups, and how long an entry may be
+# served for even if no new generation was published
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_SECONDS = 300.0
+# Stored documents are cached along with their content hash, up to a total
+# size of their values
+DOCUMENT_CACHE_MAX_ENTRIES = 4096
+DOCUMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Content hashes of the documents of a generation by key, each naming the
+# immutable copy of the document readers of the generation get, see
+# Generation.set_document()
+DOCUMENTS_KEY = "documents"
+# fts: hashes the generation replaced or removed, see
+# Generation.set_search_document()
+SUPERSEDED_KEY = "superseded"
+
+# Content encodings documents are stored in besides identity, preferred first
+ENCODINGS = ("br", "gzip")
+# Documents smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 500
+# Brotli quality of documents written by the thousand, such as per-app ones;
+# 11 compresses a few percent better but takes tens of times longer
+BROTLI_QUALITY = 7
+# For the few catalogue-wide documents
+BROTLI_QUALITY_MAX = 11
+
+# Page size of searches which don't ask for one
+SEARCH_DEFAULT_LIMIT = 250
+# RediSearch refuses to page past MAXSEARCHRESULTS, 10000 by default
+SEARCH_MAX_RESULTS = 10000
+# Fields of the fts: hashes search results are made of, besides the app id
+SEARCH_CARD_FIELDS = ("name", "summary", "icon")
+# Number of distinct searches whose results are kept in-process
+SEARCH_CACHE_MAX_ENTRIES = 1024
+# Fields search results can be filtered by, with the separator of TAG values
+SEARCH_TAG_FIELDS = {
+    "categories": ",",
+    "developer_name": ";",
+    "project_license": ";",
+    "arches": ",",
+    "verified": ",",
+}
+SEARCH_NUMERIC_FIELDS = ("downloads_last_month", "installed_size", "updated")
+# Generations an fts: hash is searched in, from since up to but excluding
+# until, see Generation.set_search_document()
+SEARCH_GENERATION_FIELDS = ("since", "until")
+SEARCH_UNTIL_LATEST = 2**53
+# Number of values facet counts are returned for, most frequent first
+SEARCH_FACET_MAX_VALUES = 50
+# Autocomplete dictionary of app names, ids and keywords, see FT.SUGADD
+SUGGESTIONS_KEY = "search:suggestions"
+SUGGEST_DEFAULT_LIMIT = 10
+
+# Limits after which a BatchWriter sends its queued commands
+BATCH_MAX_COMMANDS = 1000
+BATCH_MAX_BYTES = 4 * 1024 * 1024
 
 redis_conn = redis.Redis(
     db=config.settings.redis_db,
@@ -15,6 +98,13 @@ redis_conn = redis.Redis(
     decode_responses=True,
 )
 
+# Same server as redis_conn, for values which are not UTF-8 text
+redis_binary_conn = redis.Redis(
+    db=config.settings.redis_db,
+    host=config.settings.redis_host,
+    port=config.settings.redis_port,
+)
+
 
 def wait_for_redis():
     retries = 5
@@ -36,26 +126,662 @@ def wait_for_redis():
         raise redis.exceptions.ConnectionError
 
 
+def get_content_hash(value: Union[str, bytes]) -> str:
+    """
+    Hash of a document as stored by BatchWriter.set_document()
+    """
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    hasher = utils.Hasher()
+    hasher.add_bytes(value)
+    return hasher.hash()
+
+
+_writes: ContextVar[Optional[dict]] = ContextVar("writes", default=None)
+
+
+@contextlib.contextmanager
+def record_writes():
+    """
+    Collect the flushes of every BatchWriter used within the block, as
+    {name: {"flushes", "commands", "bytes", "seconds"}}
+    """
+    writes = {}
+    token = _writes.set(writes)
+    try:
+        yield writes
+    finally:
+        _writes.reset(token)
+
+
+class BatchWriter:
+    """
+    Non-transactional pipeline which is flushed every max_commands commands
+    or max_bytes of arguments, so that large updates neither buffer
+    unboundedly client-side nor stall the server with one huge batch
+
+    Redis commands are called on the writer like on a pipeline, their
+    replies are not returned. Every flush is logged, recorded in `flushes`
+    as (commands, bytes, seconds) and added to the totals of record_writes().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        conn: redis.Redis = None,
+        max_commands: int = BATCH_MAX_COMMANDS,
+        max_bytes: int = BATCH_MAX_BYTES,
+    ):
+        self.name = name
+        self.pipeline = (conn or redis_conn).pipeline(transaction=False)
+        self.max_commands = max_commands
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self.flushes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.pipeline.reset()
+
+    def __getattr__(self, name):
+        command = getattr(self.pipeline, name)
+
+        def queue(*args, **kwargs):
+            command(*args, **kwargs)
+
+            args, _ = self.pipeline.command_stack[-1]
+            self.queued_bytes += sum(
+                len(arg) if isinstance(arg, (str, bytes)) else 8 for arg in args
+            )
+            if (
+                len(self.pipeline) >= self.max_commands
+                or self.queued_bytes >= self.max_bytes
+            ):
+                self.flush()
+
+        return queue
+
+    def set_document(
+        self,
+        key: str,
+        value: bytes,
+        compress=True,
+        quality: int = BROTLI_QUALITY,
+    ):
+        """
+        Store a document and unless it is tiny, its compressed variants, see
+        get_document_keys()
+        """
+        if compress and len(value) >= COMPRESS_MIN_SIZE:
+            self.set(f"{key}:br", brotli.compress(value, quality=quality))
+            self.set(f"{key}:gzip", gzip.compress(value, compresslevel=9, mtime=0))
+
+        self.set(key, value)
+
+    def replace_zset(self, key: str, mapping: dict):
+        """
+        Replace the members of a sorted set, in as many batches as needed
+
+        Members are added to a staging key which is then renamed over `key`,
+        so readers never see a partially written set.
+        """
+        if not mapping:
+            self.delete(key)
+            return
+
+        staging_key = f"{key}:staging"
+        self.delete(staging_key)
+        members = list(mapping.items())
+        for i in range(0, len(members), self.max_commands):
+            self.zadd(staging_key, dict(members[i : i + self.max_commands]))
+        self.rename(staging_key, key)
+
+    def flush(self):
+        commands = len(self.pipeline)
+        if commands == 0:
+            return
+
+        start = time.perf_counter()
+        self.pipeline.execute()
+        seconds = time.perf_counter() - start
+
+        self.flushes.append((commands, self.queued_bytes, seconds))
+        if (writes := _writes.get()) is not None:
+            totals = writes.setdefault(
+                self.name,
+                {"flushes": 0, "commands": 0, "bytes": 0, "seconds": 0.0},
+            )
+            totals["flushes"] += 1
+            totals["commands"] += commands
+            totals["bytes"] += self.queued_bytes
+            totals["seconds"] += seconds
+        logger.info(
+            "%s: flushed %d commands (%d bytes) in %.3fs",
+            self.name,
+            commands,
+            self.queued_bytes,
+            seconds,
+        )
+        self.queued_bytes = 0
+
+
+_generation_cache = (0.0, None)
+
+
+def get_generation() -> Optional[int]:
+    """
+    Number of the published catalogue generation, None before the first
+    generational update
+    """
+    global _generation_cache
+
+    now = time.monotonic()
+    expires, generation = _generation_cache
+    if now < expires:
+        return generation
+
+    if (value := redis_conn.get(GENERATION_KEY)) is not None:
+        generation = int(value)
+    else:
+        generation = None
+
+    _generation_cache = (now + GENERATION_CACHE_SECONDS, generation)
+    return generation
+
+
+class VersionedCache:
+    """
+    Thread-safe in-process LRU cache whose entries expire after ttl seconds,
+    or as soon as a new catalogue generation is published
+
+    The generation is polled from Redis by get_generation(), so an update
+    served by one worker invalidates the entries of every worker within
+    GENERATION_CACHE_SECONDS.
+
+    With max_bytes, entries are also evicted once the sizes given by weigh
+    add up to more than that, and values larger than it are not cached.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        max_bytes: Optional[int] = None,
+        weigh: Callable = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.weigh = weigh
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load: Callable):
+        generation = get_generation()
+        now = time.monotonic()
+
+        with self.lock:
+            if (entry := self.entries.get(key)) is not None:
+                entry_generation, expires, value, _ = entry
+                if entry_generation == generation and now < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+
+        value = load()
+        size = self.weigh(value) if self.weigh is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return value
+
+        with self.lock:
+            if (entry := self.entries.pop(key, None)) is not None:
+                self.bytes -= entry[3]
+            self.entries[key] = (generation, now + self.ttl, value, size)
+            self.bytes += size
+            while len(self.entries) > self.maxsize or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                _, entry = self.entries.popitem(last=False)
+                self.bytes -= entry[3]
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = {
+                "entries": len(self.entries),
+                "max_entries": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+            if self.max_bytes is not None:
+                stats["bytes"] = self.bytes
+                stats["max_bytes"] = self.max_bytes
+            return stats
+
+
+cache = VersionedCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+# Search results by normalized query and page
+search_cache = VersionedCache(SEARCH_CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+# Content hash, encoding and value of stored documents by key and encoding,
+# see get_document()
+document_cache = VersionedCache(
+    DOCUMENT_CACHE_MAX_ENTRIES,
+    CACHE_TTL_SECONDS,
+    DOCUMENT_CACHE_MAX_BYTES,
+    lambda document: len(document[2]) if document is not None else 0,
+)
+
+
+def cached(func):
+    """
+    Serve the results of a read-only lookup from the in-process cache
+
+    Results are shared between callers and must not be modified.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__module__, func.__qualname__, args, tuple(kwargs.items()))
+        return cache.get(key, lambda: func(*args, **kwargs))
+
+    return wrapper
+
+
+def generation_key(generation: Optional[int], name: str) -> str:
+    if generation is None:
+        return name
+
+    return f"gen:{generation}:{name}"
+
+
+def catalogue_key(name: str) -> str:
+    """
+    Key of the catalogue-wide `name` (app, category and developer indexes,
+    rankings and totals) in the published generation
+    """
+    return generation_key(get_generation(), name)
+
+
+def get_document_key(key: str, digest: str) -> str:
+    """
+    Key the version of a document with content hash digest is stored at
+    """
+    return f"{key}@{digest}"
+
+
+def store_document(
+    p: BatchWriter,
+    generation: Optional[int],
+    key: str,
+    value: Union[str, bytes],
+    compress=True,
+    quality: int = BROTLI_QUALITY,
+) -> str:
+    """
+    Store a version of a document and make it the one of generation, which
+    is None before the first generational update, returning its content hash
+
+    The version is queued before the generation's pointer to it, so that a
+    flush splitting them never leaves the pointer naming a missing version.
+    """
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    digest = get_content_hash(value)
+    p.set_document(get_document_key(key, digest), value, compress, quality)
+    p.hset(generation_key(generation, DOCUMENTS_KEY), key, digest)
+    return digest
+
+
+class Generation:
+    """
+    New catalogue generation written by an update
+
+    Catalogue-wide keys are written under the generation's namespace and
+    become visible to readers all at once with publish(). Documents, per-app
+    and catalogue-wide, are stored as immutable versions named by their
+    content hash, see set_document(); a generation starts out with the
+    versions of the previous one and points at new ones for the documents
+    which changed, so the published generation's are never written to.
+    """
+
+    def __init__(self):
+        if (value := redis_conn.get(GENERATION_KEY)) is not None:
+            self.previous = int(value)
+        else:
+            self.previous = None
+
+        self.number = redis_conn.incr(GENERATION_COUNTER_KEY)
+        redis_conn.sadd(GENERATIONS_KEY, self.number)
+        self.removed_keys = []
+        self.removed_documents = set()
+        self.published_values = {}
+
+        self.documents = redis_conn.hgetall(self.previous_key(DOCUMENTS_KEY))
+        with BatchWriter("generation") as p:
+            documents = list(self.documents.items())
+            for i in range(0, len(documents), p.max_commands):
+                p.hset(
+                    self.key(DOCUMENTS_KEY),
+                    mapping=dict(documents[i : i + p.max_commands]),
+                )
+
+    def key(self, name: str) -> str:
+        return generation_key(self.number, name)
+
+    def previous_key(self, name: str) -> str:
+        return generation_key(self.previous, name)
+
+    def copy_set(self, p: BatchWriter, name: str):
+        p.sunionstore(self.key(name), [self.previous_key(name)])
+
+    def copy_zset(self, p: BatchWriter, name: str):
+        p.zunionstore(self.key(name), [self.previous_key(name)])
+
+    def set_document(
+        self,
+        p: BatchWriter,
+        key: str,
+        value: Union[str, bytes],
+        compress=True,
+        quality: int = BROTLI_QUALITY,
+    ):
+        """
+        Store a document for the generation, see get_document(), unless it is
+        unchanged since the previous generation
+        """
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+
+        if self.documents.get(key) == get_content_hash(value):
+            return
+
+        # Stored in place before documents were generational
+        if key not in self.documents:
+            self.delete_on_publish(*get_document_keys(key))
+
+        self.documents[key] = store_document(
+            p, self.number, key, value, compress, quality
+        )
+
+    def set_search_document(self, p: BatchWriter, key: str, digest: str, mapping: dict):
+        """
+        Store an fts: hash for the generation, under digest which must change
+        with mapping, unless it is unchanged since the previous generation
+
+        RediSearch indexes every fts: hash, each version is searched in the
+        generations from its since to its until field, see search(). The one
+        it replaces is marked as gone from this generation on.
+        """
+        if (current := self.documents.get(key)) == digest:
+            return
+
+        if current is not None:
+            self._supersede(p, get_document_key(key, current))
+        else:
+            # Stored in place before documents were generational
+            self.delete_on_publish(key)
+
+        p.hset(
+            get_document_key(key, digest),
+            mapping={
+                **mapping,
+                "since": self.number,
+                "until": SEARCH_UNTIL_LATEST,
+            },
+        )
+        p.hset(self.key(DOCUMENTS_KEY), key, digest)
+        self.documents[key] = digest
+
+    def delete_search_document(self, p: BatchWriter, key: str):
+        if (current := self.documents.pop(key, None)) is not None:
+            self._supersede(p, get_document_key(key, current))
+            p.hdel(self.key(DOCUMENTS_KEY), key)
+
+    def _supersede(self, p: BatchWriter, version_key: str):
+        # Still searched by the published generation, which is older
+        p.hset(version_key, "until", self.number)
+        p.sadd(self.key(SUPERSEDED_KEY), version_key)
+
+    def get_json_documents(self, keys: List[str]) -> list:
+        """
+        Decoded versions of the JSON documents stored for keys in the
+        generation, None for those without one
+        """
+        version_keys = [
+            get_document_key(key, self.documents[key])
+            for key in keys
+            if key in self.documents
+        ]
+        values = iter(redis_conn.mget(version_keys) if version_keys else ())
+
+        documents = []
+        for key in keys:
+            value = next(values) if key in self.documents else None
+            documents.append(json.loads(value) if value is not None else None)
+        return documents
+
+    def delete_document(self, key: str):
+        """
+        Remove a document from the generation once it is otherwise complete,
+        so that stages writing it later on don't bring it back
+        """
+        self.removed_documents.add(key)
+
+    def delete_on_publish(self, *keys: str):
+        self.removed_keys.extend(keys)
+
+    def set_on_publish(self, key: str, value: str):
+        """
+        Set a key once the generation is published, for state such as the
+        validators of loaded sources, which must not claim a source was
+        loaded by an update which failed before publishing it
+        """
+        self.published_values[key] = value
+
+    def publish(self):
+        global _generation_cache
+
+        if self.removed_documents:
+            redis_conn.hdel(self.key(DOCUMENTS_KEY), *self.removed_documents)
+            for key in self.removed_documents:
+                self.documents.pop(key, None)
+
+        self._collect()
+
+        redis_conn.set(GENERATION_KEY, self.number)
+        _generation_cache = (
+            time.monotonic() + GENERATION_CACHE_SECONDS,
+            self.number,
+        )
+
+        with BatchWriter("generation cleanup") as p:
+            for key, value in self.published_values.items():
+                p.set(key, value)
+            for key in self.removed_keys:
+                p.unlink(key)
+
+    def _collect(self):
+        """
+        Delete the generations older than the previous one, kept for readers
+        which have not seen the new pointer yet, and any other which failed
+        before being published, along with the document versions no longer
+        used by this one, the previous one or one still being written
+
+        Runs before this generation is published, so that fts: hashes of a
+        failed generation are never searched.
+        """
+        stale = []
+        current = {
+            get_document_key(key, digest) for key, digest in self.documents.items()
+        }
+        used = set(current)
+        kept = {self.previous}
+        for generation in redis_conn.smembers(GENERATIONS_KEY):
+            generation = int(generation)
+            if generation == self.previous or generation > self.number:
+                kept.add(generation)
+            elif generation < self.number:
+                stale.append(generation)
+
+        for generation in kept:
+            used.update(
+                get_document_key(key, digest)
+                for key, digest in redis_conn.hgetall(
+                    generation_key(generation, DOCUMENTS_KEY)
+                ).items()
+            )
+
+        with BatchWriter("generation cleanup") as p:
+            unused = set()
+            for generation in stale:
+                documents = redis_conn.hgetall(
+                    generation_key(generation, DOCUMENTS_KEY)
+                )
+                for key, digest in documents.items():
+                    if (version_key := get_document_key(key, digest)) not in used:
+                        unused.add(version_key)
+
+                # Replaced by a generation which was never published
+                for version_key in redis_conn.smembers(
+                    generation_key(generation, SUPERSEDED_KEY)
+                ):
+                    if version_key in current:
+                        p.hset(version_key, "until", SEARCH_UNTIL_LATEST)
+
+            for version_key in unused:
+                for key in get_document_keys(version_key):
+                    p.unlink(key)
+
+            for generation in stale:
+                for key in redis_conn.scan_iter(f"gen:{generation}:*", count=1000):
+                    p.unlink(key)
+                p.srem(GENERATIONS_KEY, generation)
+
+
+def _get_search_schema() -> list:
+    return [
+        TextField("id"),
+        TextField("name"),
+        TextField("summary"),
+        TextField("description"),
+        TextField("keywords"),
+        *[
+            TagField(name, separator=separator)
+            for name, separator in SEARCH_TAG_FIELDS.items()
+        ],
+        *[
+            NumericField(name)
+            for name in SEARCH_NUMERIC_FIELDS + SEARCH_GENERATION_FIELDS
+        ],
+    ]
+
+
 def initialize():
+    schema = _get_search_schema()
+    index = redis_conn.ft()
+
+    # An index with an outdated schema is rebuilt, the fts: hashes are kept and
+    # RediSearch reindexes them in the background
+    try:
+        fields = {attribute[1] for attribute in index.info()["attributes"]}
+        if fields != {field.name for field in schema}:
+            index.dropindex(delete_documents=False)
+    except:
+        pass
+
     try:
         definition = IndexDefinition(prefix=["fts:"])
-        redis_conn.ft().create_index(
-            (
-                TextField("id"),
-                TextField("name"),
-                TextField("summary"),
-                TextField("description"),
-                TextField("keywords"),
-            ),
-            definition=definition,
-        )
+        index.create_index(schema, definition=definition)
     except:
         pass
 
 
-def search(search_term: str):
-    results = []
+def _escape_tag(value: str) -> str:
+    return re.sub(r"(\W)", r"\\\1", value)
+
+
+def build_filter_query(filters: dict) -> str:
+    """
+    Turn {field: value} for TAG fields and {field: (min, max)} for NUMERIC
+    fields, with None for an open end, into RediSearch filter clauses
+    """
+    clauses = []
+    for field, value in sorted(filters.items()):
+        if field in SEARCH_TAG_FIELDS:
+            clauses.append(f"@{field}:{{{_escape_tag(value)}}}")
+        elif field in SEARCH_NUMERIC_FIELDS:
+            minimum, maximum = value
+            minimum = "-inf" if minimum is None else minimum
+            maximum = "+inf" if maximum is None else maximum
+            clauses.append(f"@{field}:[{minimum} {maximum}]")
+        else:
+            raise ValueError(f"Unknown search filter {field}")
+
+    return " ".join(clauses)
+
+
+def _build_search_query(query_string: str, offset: int, limit: int) -> Query:
+    if limit == 0:
+        # LIMIT 0 0 is the only page RediSearch allows past MAXSEARCHRESULTS
+        return Query(query_string).no_content().paging(0, 0)
+
+    return Query(query_string).return_fields(*SEARCH_CARD_FIELDS).paging(offset, limit)
+
+
+def _build_facet_request(query_string: str, field: str) -> AggregateRequest:
+    separator = SEARCH_TAG_FIELDS[field]
+    return (
+        AggregateRequest(query_string)
+        .load(f"@{field}")
+        .filter(f"exists(@{field})")
+        .apply(value=f'split(@{field}, "{separator}")')
+        .group_by("@value", reducers.count().alias("count"))
+        .sort_by(Desc("@count"), max=SEARCH_FACET_MAX_VALUES)
+    )
+
 
+def _get_facet_counts(response: list) -> dict:
+    counts = {}
+    for row in response[1:]:
+        row = dict(zip(row[::2], row[1::2]))
+        if row.get("value"):
+            counts[row["value"]] = int(row["count"])
+
+    return counts
+
+
+def _get_search_card(doc: Document) -> dict:
+    card = {"id": doc.id[len("fts:") :].partition("@")[0]}
+    for field in SEARCH_CARD_FIELDS:
+        card[field] = getattr(doc, field, None)
+
+    return card
+
+
+def normalize_search_term(search_term: str) -> str:
+    """
+    Reduce a user query to the terms the index is searched for, so queries
+    differing only in case, spacing or reserved characters share a cache entry
+    """
     # TODO: figure out how to escape dashes
     # "D-Feet" seems to be interpreted as "d and not feet"
     search_term = search_term.replace("-", " ")
@@ -84,32 +810,117 @@ def search(search_term: str):
     for char in reserved_chars:
         search_term = search_term.replace(char, "")
 
-    if len(search_term.strip()) == 0:
-        return None
+    # The index is case-insensitive
+    return " ".join(search_term.lower().split())
+
+
+def search(
+    search_term: str,
+    offset: int = 0,
+    limit: int = SEARCH_DEFAULT_LIMIT,
+    filters: Optional[dict] = None,
+    facets: Sequence[str] = (),
+) -> Tuple[int, List[dict], dict]:
+    """
+    Return the total number of hits, the app cards of the requested page and
+    the number of hits by value of each of the facets, see build_filter_query()
+    for filters
+
+    Results are cached in-process until the next catalogue generation is
+    published.
+    """
+    search_term = normalize_search_term(search_term)
+    if not search_term:
+        return 0, [], {}
 
-    # TODO: should input be sanitized here?
-    generic_query = Query(build_query(f"{search_term}*")).no_content()
+    if offset < 0 or limit <= 0:
+        return 0, [], {}
 
-    # TODO: Backend API doesn't support paging so bring twohundredfifty results
-    # instead of just 10, which is the redis default
-    generic_query.paging(0, 250)
+    # Pages reaching past MAXSEARCHRESULTS are cut short, those entirely past it
+    # only count the hits
+    limit = max(min(limit, SEARCH_MAX_RESULTS - offset), 0)
 
-    search_results = redis_conn.ft().search(generic_query)
-    for doc in search_results.docs:
-        results.append(doc.id)
+    filter_query = build_filter_query(filters or {})
+    facets = tuple(dict.fromkeys(facets))
+
+    return search_cache.get(
+        (search_term, offset, limit, filter_query, facets),
+        lambda: _search(search_term, offset, limit, filter_query, facets),
+    )
+
+
+def _search(
+    search_term: str,
+    offset: int,
+    limit: int,
+    filter_query: str,
+    facets: Tuple[str, ...],
+) -> Tuple[int, List[dict], dict]:
+    """
+    The prefix query and its fuzzy fallback, each with its facet aggregations,
+    are pipelined, so a search costs a single round trip, and the fallback is
+    only used when the prefix query found nothing.
+    """
+    search_terms = [f"{search_term}*"]
 
     # redis does not support fuzzy search for non-alphabet strings
-    if not len(results):
-        if search_term.isalpha():
-            query = Query(build_query(f"%{search_term}%")).no_content()
-            search_results = redis_conn.ft().search(query)
+    if search_term.isalpha():
+        search_terms.append(f"%{search_term}%")
 
-            for doc in search_results.docs:
-                results.append(doc.id)
-        else:
-            return None
+    # Only the versions of the published generation, see
+    # Generation.set_search_document()
+    generation = get_generation() or 0
+    visible = f"@since:[-inf {generation}] @until:[({generation} +inf]"
+
+    index = redis_conn.ft()
+    with redis_conn.pipeline(transaction=False) as p:
+        for term in search_terms:
+            query_string = f"{build_query(term)} {filter_query} {visible}"
+            query = _build_search_query(query_string, offset, limit)
+            p.execute_command(SEARCH_CMD, index.index_name, *query.get_args())
+            for field in facets:
+                request = _build_facet_request(query_string, field)
+                p.execute_command(
+                    AGGREGATE_CMD, index.index_name, *request.build_args()
+                )
+        responses = p.execute()
+
+    step = 1 + len(facets)
+    for i in range(0, len(responses), step):
+        search_results = Result(responses[i], hascontent=True)
+        if search_results.total:
+            return (
+                search_results.total,
+                [_get_search_card(doc) for doc in search_results.docs],
+                {
+                    field: _get_facet_counts(response)
+                    for field, response in zip(facets, responses[i + 1 : i + step])
+                },
+            )
+
+    return 0, [], {}
+
+
+def suggest(prefix: str, limit: int = SUGGEST_DEFAULT_LIMIT) -> List[dict]:
+    """
+    Return the completions of prefix, most downloaded first, with the id of
+    the app they name, or None for keywords
+    """
+    prefix = " ".join(prefix.casefold().split())
+    if not prefix or limit <= 0:
+        return []
+
+    return search_cache.get(("suggest", prefix, limit), lambda: _suggest(prefix, limit))
 
-    return results
+
+def _suggest(prefix: str, limit: int) -> List[dict]:
+    suggestions = redis_conn.ft().sugget(
+        catalogue_key(SUGGESTIONS_KEY), prefix, num=limit, with_payloads=True
+    )
+    return [
+        {"text": suggestion.string, "id": suggestion.payload}
+        for suggestion in suggestions
+    ]
 
 
 def build_query(search_term: str):
@@ -135,9 +946,67 @@ def get_json_key(key: str):
     return None
 
 
-def get_app_count() -> int:
-    return redis_conn.scard("apps:index")
+def get_document_keys(key: str) -> List[str]:
+    """
+    Keys of a document stored with BatchWriter.set_document() and of its
+    variants in each of ENCODINGS
+    """
+    return [key, *(f"{key}:{encoding}" for encoding in ENCODINGS)]
+
+
+def get_document(
+    key: str, encoding: Optional[str] = None
+) -> Optional[Tuple[str, Optional[str], bytes]]:
+    """
+    Content hash, encoding and value of the published generation's version
+    of the document stored for key with Generation.set_document(), in
+    encoding if it has such a variant and as is otherwise, None if there is
+    no such document
+
+    Versions are never written to once stored, so the hash always matches
+    the value. Both are cached as one entry.
+    """
+    return document_cache.get(
+        (key, encoding), lambda: _get_document(key, get_generation(), encoding)
+    )
+
+
+def get_json_document(key: str, generation: Optional[int]):
+    """
+    Decoded version of the JSON document stored for key in generation
+    """
+    if (document := _get_document(key, generation, None)) is not None:
+        return json.loads(document[2])
+
+    return None
+
+
+def _get_document(
+    key: str, generation: Optional[int], encoding: Optional[str]
+) -> Optional[Tuple[str, Optional[str], bytes]]:
+    digest = redis_conn.hget(generation_key(generation, DOCUMENTS_KEY), key)
+    if digest is None:
+        return None
+
+    version_key = get_document_key(key, digest)
+    value = None
+    if encoding is not None:
+        value = redis_binary_conn.get(f"{version_key}:{encoding}")
+
+    # Small documents are only stored as is
+    if value is None:
+        encoding = None
+        value = redis_binary_conn.get(version_key)
+
+    if value is None:
+        return None
+
+    return digest, encoding, value
 
 
+@cached
 def get_developers():
-    return {developer for developer in redis_conn.smembers("developers:index")}
+    return {
+        developer
+        for developer in redis_conn.smembers(catalogue_key("developers:index"))
+    }
@@ -1,19 +1,31 @@
 from datetime import datetime
+from typing import Optional
 
 from feedgen.feed import FeedGenerator
 
 from . import db
 
 
-def generate_feed(key: str, title: str, description: str, link: str):
+def generate_feed(
+    zset_name: str,
+    title: str,
+    description: str,
+    link: str,
+    generation: Optional[int],
+):
     feed = FeedGenerator()
     feed.title(title)
     feed.description(description)
     feed.link(href=link)
     feed.language("en")
 
-    appids = db.redis_conn.zrevrange(key, 0, 10, withscores=True)
-    apps = [(db.get_json_key(f"apps:{appid[0]}"), appid[1]) for appid in appids]
+    appids = db.redis_conn.zrevrange(
+        db.generation_key(generation, zset_name), 0, 10, withscores=True
+    )
+    apps = [
+        (db.get_json_document(f"apps:{appid[0]}", generation), appid[1])
+        for appid in appids
+    ]
 
     for app, timestamp in reversed(apps):
         # sanity check: if index includes an app, but apps:ID is null, skip it
@@ -72,19 +84,37 @@ def generate_feed(key: str, title: str, description: str, link: str):
     return feed.rss_str()
 
 
-def get_recently_updated_apps_feed():
+def get_recently_updated_apps_feed(generation: Optional[int]):
     return generate_feed(
         "recently_updated_zset",
         "Flathub – recently updated applications",
         "Recently updated applications published on Flathub",
         "https://flathub.org/apps/collection/recently-updated",
+        generation,
     )
 
 
-def get_new_apps_feed():
+def get_new_apps_feed(generation: Optional[int]):
     return generate_feed(
         "new_apps_zset",
         "Flathub – recently added applications",
         "Applications recently published on Flathub",
         "https://flathub.org/apps/collection/new",
+        generation,
     )
+
+
+def update(generation: db.Generation):
+    with db.BatchWriter("feeds") as p:
+        generation.set_document(
+            p,
+            "feed:recently-updated",
+            get_recently_updated_apps_feed(generation.number),
+            quality=db.BROTLI_QUALITY_MAX,
+        )
+        generation.set_document(
+            p,
+            "feed:new",
+            get_new_apps_feed(generation.number),
+            quality=db.BROTLI_QUALITY_MAX,
+        )
@@ -1,7 +1,9 @@
-from functools import lru_cache
+import datetime
+import json
+from typing import List, Optional
 
 import sentry_sdk
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 
@@ -15,9 +17,15 @@ from . import (
     schemas,
     stats,
     summary,
+    utils,
     verification,
 )
 
+# Per-app documents are only rewritten when their content changes
+CACHE_CONTROL_DOCUMENT = "public, max-age=3600"
+# Listings, rankings and feeds change with every update
+CACHE_CONTROL_CATALOGUE = "public, max-age=300"
+
 app = FastAPI(title=config.settings.app_name)
 if config.settings.sentry_dsn:
     sentry_sdk.init(
@@ -43,6 +51,113 @@ if config.settings.enable_login_support:
 verification.register_to_app(app)
 
 
+def _json_passthrough(value: bytes, response: Response) -> Response:
+    return Response(
+        content=value, media_type="application/json", headers=dict(response.headers)
+    )
+
+
+def _etag(*parts) -> str:
+    hasher = utils.Hasher()
+    for part in parts:
+        hasher.add_string(f"{part}\0")
+    return f'"{hasher.hash()}"'
+
+
+def _catalogue_etag(request: Request) -> Optional[str]:
+    # Everything derived from the catalogue is fixed within a generation
+    if (generation := db.get_generation()) is None:
+        return None
+    return _etag(generation, request.url.path, request.url.query)
+
+
+def _check_etag(
+    request: Request, response: Response, etag: Optional[str], cache_control: str
+) -> Optional[Response]:
+    """
+    Set the resource's validators on response, returning a 304 response if
+    the client's If-None-Match already names the current version
+    """
+    if etag is None:
+        return None
+
+    response.headers["Cache-Control"] = cache_control
+    response.headers["ETag"] = etag
+    if if_none_match := request.headers.get("if-none-match"):
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=dict(response.headers))
+
+    return None
+
+
+def _get_encoding(request: Request) -> Optional[str]:
+    accepted = {}
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        quality = 1.0
+        if (params := params.strip()).startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in db.ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def _stored_response(
+    request: Request,
+    response: Response,
+    key: str,
+    cache_control: str,
+    media_type: str = "application/json",
+) -> Optional[Response]:
+    """
+    Serve the published generation's version of the document stored for
+    key in the best encoding the client accepts, None if there is no such
+    document
+
+    Compressed variants are stored by BatchWriter.set_document(), nothing is
+    compressed per request. The document's content hash is its validator.
+    """
+    response.headers["Vary"] = "Accept-Encoding"
+
+    if (document := db.get_document(key, _get_encoding(request))) is None:
+        return None
+
+    digest, encoding, value = document
+    etag = f'"{digest}"'
+
+    # Every encoding is a separate representation with its own validator
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+        etag = f'{etag[:-1]}-{encoding}"'
+
+    if not_modified := _check_etag(request, response, etag, cache_control):
+        return not_modified
+
+    return Response(
+        content=value, media_type=media_type, headers=dict(response.headers)
+    )
+
+
+def _add_json_field(document: bytes, name: str, value) -> bytes:
+    # Append a field to a stored JSON object without decoding it
+    head = document.rstrip()[:-1].rstrip()
+    separator = b"" if head.endswith(b"{") else b","
+    return b"%s%s%s:%s}" % (
+        head,
+        separator,
+        json.dumps(name).encode(),
+        json.dumps(value).encode(),
+    )
+
+
 @app.on_event("startup")
 def startup_event():
     db.wait_for_redis()
@@ -53,30 +168,49 @@ def startup_event():
 
 
 @app.post("/update")
-def update():
-    new_apps = apps.load_appstream()
-    summary.update()
-    picks.update()
-    stats.update()
-    verification.update()
-
-    if new_apps:
+def update(force: bool = False):
+    with db.record_writes() as writes:
+        generation = db.Generation()
+        new_apps = apps.load_appstream(generation, force)
+        summary_updated = summary.update(generation, force)
+        picks.update(generation)
+        stats.update(generation)
+        verification.update()
+        apps.update_search_index(generation)
+        apps.update_suggestions(generation)
+
+        new_appids = sorted(new_apps or ())
         new_apps_zset = {}
-        for appid in new_apps:
-            if metadata := db.get_json_key(f"summary:{appid}"):
+        for appid, metadata in zip(
+            new_appids,
+            generation.get_json_documents([f"summary:{appid}" for appid in new_appids]),
+        ):
+            if metadata:
                 new_apps_zset[appid] = metadata.get("timestamp", 0)
-        if new_apps_zset:
-            db.redis_conn.zadd("new_apps_zset", new_apps_zset)
 
-    get_recently_updated.cache_clear()
+        with db.BatchWriter("new apps") as p:
+            generation.copy_zset(p, "new_apps_zset")
+            if new_apps_zset:
+                p.zadd(generation.key("new_apps_zset"), new_apps_zset)
+
+        feeds.update(generation)
+        generation.publish()
+
+    return {
+        "appstream": "unchanged" if new_apps is None else "updated",
+        "summary": "unchanged" if summary_updated is None else "updated",
+        # Redis writes per stage, see db.BatchWriter
+        "writes": writes,
+    }
 
 
 @app.get("/category/{category}")
 def get_category(
     category: schemas.Category,
+    request: Request,
+    response: Response,
     page: int = None,
     per_page: int = None,
-    response: Response = Response,
 ):
     if (page is None and per_page is not None) or (
         page is not None and per_page is None
@@ -84,91 +218,216 @@ def get_category(
         response.status_code = 400
         return response
 
-    ids = apps.get_category(category)
-
-    sorted_ids = sort_ids_by_downloads(ids)
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
 
     if page is None:
-        return sorted_ids
+        return stats.get_sorted_by_downloads(f"categories:{category.value}")
     else:
-        return sorted_ids.__getitem__(slice(per_page * (page - 1), per_page * page))
+        return stats.get_sorted_by_downloads(
+            f"categories:{category.value}", per_page * (page - 1), per_page
+        )
 
 
 @app.get("/developer/")
-def get_developers():
+def get_developers(request: Request, response: Response):
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
     return db.get_developers()
 
 
 @app.get("/developer/{developer}")
 def get_developer(
     developer: str,
+    request: Request,
     response: Response,
 ):
-    ids = apps.get_developer(developer)
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
+    ids = stats.get_sorted_by_downloads(f"developers:{developer}")
 
     if not ids:
         response.status_code = 404
         return response
 
-    sorted_ids = sort_ids_by_downloads(ids)
-
-    return sorted_ids
+    return ids
 
 
 @app.get("/appstream")
-def list_appstream():
+def list_appstream(request: Request, response: Response):
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
     return apps.list_appstream()
 
 
 @app.get("/appstream/{appid}", status_code=200)
-def get_appstream(appid: str, response: Response):
-    if value := db.get_json_key(f"apps:{appid}"):
-        return value
+def get_appstream(appid: str, request: Request, response: Response):
+    if stored := _stored_response(
+        request, response, f"apps:{appid}", CACHE_CONTROL_DOCUMENT
+    ):
+        return stored
 
     response.status_code = 404
     return None
 
 
+@app.get("/search/suggest/{prefix}")
+def get_suggestions(prefix: str, limit: int = db.SUGGEST_DEFAULT_LIMIT):
+    return db.suggest(prefix, limit)
+
+
 @app.get("/search/{userquery}")
-def search(userquery: str):
-    return apps.search(userquery)
+def search(
+    userquery: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(db.SEARCH_DEFAULT_LIMIT, ge=1),
+    category: str = None,
+    developer_name: str = None,
+    project_license: str = None,
+    arch: str = None,
+    verified: bool = None,
+    min_downloads: int = None,
+    max_installed_size: int = None,
+    updated_since: int = None,
+    facets: List[schemas.SearchFacet] = Query([]),
+):
+    filters = {}
+    if category is not None:
+        filters["categories"] = category
+    if developer_name is not None:
+        filters["developer_name"] = developer_name
+    if project_license is not None:
+        filters["project_license"] = project_license
+    if arch is not None:
+        filters["arches"] = arch
+    if verified is not None:
+        filters["verified"] = "true" if verified else "false"
+    if min_downloads is not None:
+        # Only the bucket of an app's downloads is indexed, which is at least
+        # a bucket boundary exactly when the downloads are
+        if apps.get_downloads_bucket(min_downloads) != min_downloads:
+            raise HTTPException(
+                status_code=422,
+                detail="min_downloads must be 0, or 1, 2 or 5 times a power of ten",
+            )
+        filters["downloads_last_month"] = (min_downloads, None)
+    if max_installed_size is not None:
+        filters["installed_size"] = (None, max_installed_size)
+    if updated_since is not None:
+        filters["updated"] = (updated_since, None)
+
+    return apps.search(
+        userquery, offset, limit, filters, [facet.value for facet in facets]
+    )
 
 
 @app.get("/collection/recently-updated")
 @app.get("/collection/recently-updated/{limit}")
-@lru_cache()
-def get_recently_updated(limit: int = 100):
+def get_recently_updated(request: Request, response: Response, limit: int = 100):
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
     return apps.get_recently_updated(limit)
 
 
+@app.get("/collection/trending")
+def get_trending(
+    request: Request, response: Response, offset: int = 0, limit: int = None
+):
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
+    return stats.get_trending(offset, limit)
+
+
 @app.get("/picks/{pick}")
-def get_picks(pick: str, response: Response):
-    if picks_ids := picks.get_pick(pick):
-        return picks_ids
+def get_picks(pick: str, request: Request, response: Response):
+    if stored := _stored_response(
+        request, response, f"picks:{pick}", CACHE_CONTROL_DOCUMENT
+    ):
+        return stored
 
     response.status_code = 404
 
 
+def _get_popular(
+    request: Request,
+    response: Response,
+    days: Optional[int],
+    offset: int,
+    limit: Optional[int],
+    arch: Optional[str],
+):
+    if offset == 0 and limit is None and arch is None:
+        key = stats.get_popular_document_key(days)
+        if stored := _stored_response(request, response, key, CACHE_CONTROL_CATALOGUE):
+            return stored
+
+    etag = _catalogue_etag(request)
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_CATALOGUE):
+        return not_modified
+
+    return stats.get_popular(days, offset, limit, arch)
+
+
 @app.get("/popular")
-def get_popular():
-    return stats.get_popular(None)
+def get_popular(
+    request: Request,
+    response: Response,
+    offset: int = 0,
+    limit: int = None,
+    arch: str = None,
+):
+    return _get_popular(request, response, None, offset, limit, arch)
 
 
 @app.get("/popular/{days}")
-def get_popular_days(days: int):
-    return stats.get_popular(days)
+def get_popular_days(
+    days: int,
+    request: Request,
+    response: Response,
+    offset: int = 0,
+    limit: int = None,
+    arch: str = None,
+):
+    return _get_popular(request, response, days, offset, limit, arch)
+
+
+def _get_feed(request: Request, response: Response, name: str):
+    if stored := _stored_response(
+        request,
+        response,
+        f"feed:{name}",
+        CACHE_CONTROL_CATALOGUE,
+        media_type="application/rss+xml",
+    ):
+        return stored
+
+    # Not generated by an update yet
+    if name == "new":
+        content = feeds.get_new_apps_feed(db.get_generation())
+    else:
+        content = feeds.get_recently_updated_apps_feed(db.get_generation())
+    return Response(content=content, media_type="application/rss+xml")
 
 
 @app.get("/feed/recently-updated")
-def get_recently_updated_apps_feed():
-    return Response(
-        content=feeds.get_recently_updated_apps_feed(), media_type="application/rss+xml"
-    )
+def get_recently_updated_apps_feed(request: Request, response: Response):
+    return _get_feed(request, response, "recently-updated")
 
 
 @app.get("/feed/new")
-def get_new_apps_feed():
-    return Response(content=feeds.get_new_apps_feed(), media_type="application/rss+xml")
+def get_new_apps_feed(request: Request, response: Response):
+    return _get_feed(request, response, "new")
 
 
 @app.get("/status", status_code=200)
@@ -176,44 +435,58 @@ def healthcheck():
     return {"status": "OK"}
 
 
+@app.get("/status/cache", status_code=200)
+def get_cache_stats():
+    # Counters are per worker process
+    return {
+        "lookups": db.cache.get_stats(),
+        "search": db.search_cache.get_stats(),
+        "documents": db.document_cache.get_stats(),
+    }
+
+
 @app.get("/stats", status_code=200)
-def get_stats(response: Response):
-    if value := db.get_json_key("stats"):
-        return value
+def get_stats(request: Request, response: Response):
+    if stored := _stored_response(request, response, "stats", CACHE_CONTROL_CATALOGUE):
+        return stored
 
     response.status_code = 404
     return None
 
 
 @app.get("/stats/{appid}", status_code=200)
-def get_stats_for_app(appid: str, response: Response):
-    if value := stats.get_downloads_by_ids([appid]).get(appid, None):
-        return value
+def get_stats_for_app(
+    appid: str,
+    request: Request,
+    response: Response,
+    from_: datetime.date = Query(None, alias="from"),
+    to: datetime.date = None,
+    resolution: schemas.StatsResolution = schemas.StatsResolution.day,
+):
+    if (document := stats.get_downloads_document(appid)) is None:
+        response.status_code = 404
+        return None
 
-    response.status_code = 404
-    return None
+    # The series change with the totals, or else only grow by a day
+    digest, _, value = document
+    if digest is not None:
+        etag = _etag(digest, stats.get_series_end(), request.url.query)
+    else:
+        etag = None
+    if not_modified := _check_etag(request, response, etag, CACHE_CONTROL_DOCUMENT):
+        return not_modified
+
+    if series := stats.get_app_series(appid, resolution.value, from_, to):
+        value = _add_json_field(value, f"downloads_per_{resolution.value}", series)
+    return _json_passthrough(value, response)
 
 
 @app.get("/summary/{appid}", status_code=200)
-def get_summary(appid: str, response: Response):
-    if value := db.get_json_key(f"summary:{appid}"):
-        return value
+def get_summary(appid: str, request: Request, response: Response):
+    if stored := _stored_response(
+        request, response, f"summary:{appid}", CACHE_CONTROL_DOCUMENT
+    ):
+        return stored
 
     response.status_code = 404
     return None
-
-
-def sort_ids_by_downloads(ids):
-    if len(ids) <= 1:
-        return ids
-
-    downloads = stats.get_downloads_by_ids(ids)
-    sorted_ids = sorted(
-        ids,
-        key=lambda appid: downloads.get(appid, {"downloads_last_month": 0}).get(
-            "downloads_last_month", 0
-        ),
-        reverse=True,
-    )
-
-    return sorted_ids
@@ -6,8 +6,16 @@ import requests
 from . import config, db, utils
 
 
-def update():
-    with db.redis_conn.pipeline() as p:
+def _get_bundled_picks() -> dict:
+    picks_dir = os.path.join(config.settings.datadir, "picks")
+    return {
+        pick_json[:-5]: utils.get_appids(os.path.join(picks_dir, pick_json))
+        for pick_json in os.listdir(picks_dir)
+    }
+
+
+def update(generation: db.Generation):
+    with db.BatchWriter("picks") as p:
         with requests.Session() as session:
             for pick in ["games", "apps"]:
                 r = session.get(
@@ -17,21 +25,20 @@ def update():
                     # Decode JSON to ensure it's not malformed
                     content = r.json()
 
-                    p.set(f"picks:{pick}", json.dumps(content))
+                    generation.set_document(p, f"picks:{pick}", json.dumps(content))
 
-        p.execute()
+        # Carried over from the previous generation unless fetched, the
+        # bundled ones stand in for any it didn't have
+        for pick, value in _get_bundled_picks().items():
+            if f"picks:{pick}" not in generation.documents:
+                generation.set_document(p, f"picks:{pick}", json.dumps(value))
 
 
 def initialize():
-    picks_dir = os.path.join(config.settings.datadir, "picks")
-    with db.redis_conn.pipeline() as p:
-        for pick_json in os.listdir(picks_dir):
-            value = utils.get_appids(os.path.join(picks_dir, pick_json))
-            p.set(f"picks:{pick_json[:-5]}", json.dumps(value))
-        p.execute()
-
+    # Stored with every update, these only stand in until the first one
+    if db.get_generation() is not None:
+        return
 
-def get_pick(pick):
-    if value := db.redis_conn.get(f"picks:{pick}"):
-        return json.loads(value)
-    return None
+    with db.BatchWriter("picks") as p:
+        for pick, value in _get_bundled_picks().items():
+            db.store_document(p, None, f"picks:{pick}", json.dumps(value))
@@ -14,3 +14,17 @@ class Category(str, Enum):
     Science = "Science"
     System = "System"
     Utility = "Utility"
+
+
+class StatsResolution(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+
+
+class SearchFacet(str, Enum):
+    categories = "categories"
+    developer_name = "developer_name"
+    project_license = "project_license"
+    arches = "arches"
+    verified = "verified"
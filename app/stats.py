@@ -1,18 +1,52 @@
 import datetime
+import io
+import itertools
 import json
-from collections import defaultdict
-from typing import Dict, List, Optional
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 from urllib.parse import urlparse, urlunparse
 
+import numpy as np
 import requests
 
-from . import config, db
+from . import config, db, stats_cache
 
-StatsType = Dict[str, Dict[str, List[int]]]
-POPULAR_DAYS_NUM = 7
+# Windows, in days, for which popularity rankings are precomputed
+POPULAR_WINDOWS = (1, 7, 30, 90)
+
+# Trending compares the last week of finalized days to the four weeks before,
+# in average installs per day
+TRENDING_RECENT_DAYS = 7
+TRENDING_BASELINE_DAYS = 28
+TRENDING_DAMPING = 10
 
 FIRST_STATS_DATE = datetime.date(2018, 4, 29)
 
+# Running totals over finalized days, see StatsAggregator
+STATS_STATE_KEY = "stats:state"
+STATS_DOWNLOADS_KEY = "stats:downloads"
+# Per-arch daily counts are only kept for the most recent days, enough for
+# the longest per-arch window short of all time
+ARCH_DAYS = max(POPULAR_WINDOWS)
+DOWNLOADS_ZSET_KEY = "downloads_last_month_zset"
+
+# Per-app series are packed little-endian, one value per day, week or month
+SERIES_RESOLUTIONS = ("day", "week", "month")
+SERIES_DTYPE = np.dtype("<i4")
+# Weeks start on Monday
+SERIES_FIRST_WEEK = FIRST_STATS_DATE - datetime.timedelta(
+    days=FIRST_STATS_DATE.weekday()
+)
+# Last day of the series, per generation
+SERIES_END_KEY = "app_stats_series_end"
+
+
+def _date_range(sdate: datetime.date, edate: datetime.date):
+    for i in range((edate - sdate).days + 1):
+        yield sdate + datetime.timedelta(days=i)
+
 
 def _get_stats_for_date(date: datetime.date, session: requests.Session):
     stats_json_url = urlparse(
@@ -25,6 +59,11 @@ def _get_stats_for_date(date: datetime.date, session: requests.Session):
         except FileNotFoundError:
             return None
         return stats
+
+    final = stats_cache.is_final(date)
+    if final and (stats := stats_cache.get(date)) is not None:
+        return stats
+
     redis_key = f"stats:date:{date.isoformat()}"
     stats_txt = db.redis_conn.get(redis_key)
     if stats_txt is None:
@@ -33,6 +72,10 @@ def _get_stats_for_date(date: datetime.date, session: requests.Session):
             return None
         response.raise_for_status()
         stats = response.json()
+        if final:
+            stats_cache.put(date, response.content)
+            return stats
+
         if date == datetime.date.today():
             expire = 60 * 60
         else:
@@ -43,204 +86,781 @@ def _get_stats_for_date(date: datetime.date, session: requests.Session):
     return stats
 
 
-def _get_stats_for_period(sdate: datetime.date, edate: datetime.date):
-    totals: StatsType = {}
-    with requests.Session() as session:
-        for i in range((edate - sdate).days + 1):
-            date = sdate + datetime.timedelta(days=i)
-            stats = _get_stats_for_date(date, session)
+def _iter_stats_for_dates(dates: Iterable[datetime.date]):
+    """
+    Yield (date, stats) for every one of dates, in order
+
+    Days are fetched ahead of the consumer by a pool of
+    stats_fetch_concurrency threads, each with its own requests session.
+    """
+    concurrency = max(1, config.settings.stats_fetch_concurrency)
+    sessions = []
+    local = threading.local()
+
+    def fetch(date: datetime.date):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        return _get_stats_for_date(date, local.session)
+
+    dates = iter(dates)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque(
+                (date, executor.submit(fetch, date))
+                for date in itertools.islice(dates, 2 * concurrency)
+            )
+            while pending:
+                date, future = pending.popleft()
+                if next_date := next(dates, None):
+                    pending.append((next_date, executor.submit(fetch, next_date)))
+                yield date, future.result()
+    finally:
+        for session in sessions:
+            session.close()
 
-            if stats is None or "refs" not in stats or stats["refs"] is None:
-                continue
-            for app_id, app_stats in stats["refs"].items():
-                if app_id not in totals:
-                    totals[app_id] = {}
-                app_totals = totals[app_id]
-                for arch, downloads in app_stats.items():
-                    if arch not in app_totals:
-                        app_totals[arch] = [0, 0, 0]
-                    app_totals[arch][0] += downloads[0]
-                    app_totals[arch][1] += downloads[1]
-                    app_totals[arch][2] += downloads[0] - downloads[1]
-    return totals
-
-
-def _get_app_stats_per_day() -> Dict[str, Dict[str, int]]:
-    # Skip last two days as flathub-stats publishes partial statistics
-    edate = datetime.date.today() - datetime.timedelta(days=2)
-    sdate = FIRST_STATS_DATE
-
-    app_stats_per_day: Dict[str, Dict[str, int]] = {}
-
-    with requests.Session() as session:
-        for i in range((edate - sdate).days + 1):
-            date = sdate + datetime.timedelta(days=i)
-            stats = _get_stats_for_date(date, session)
-
-            if stats is not None and "refs" in stats and stats["refs"] is not None:
-                for app_id, app_stats in stats["refs"].items():
-                    if _is_app(app_id):
-                        if app_id not in app_stats_per_day:
-                            app_stats_per_day[app_id] = {}
-                        app_stats_per_day[app_id][date.isoformat()] = sum(
-                            [i[0] - i[1] for i in app_stats.values()]
-                        )
-    return app_stats_per_day
-
-
-def _get_stats() -> Dict[str, Dict[str, int]]:
-    edate = datetime.date.today()
-    sdate = FIRST_STATS_DATE
-
-    downloads_per_day: Dict[str, int] = {}
-    delta_downloads_per_day: Dict[str, int] = {}
-    updates_per_day: Dict[str, int] = {}
-    totals_country: Dict[str, int] = {}
-    with requests.Session() as session:
-        for i in range((edate - sdate).days + 1):
-            date = sdate + datetime.timedelta(days=i)
-            stats = _get_stats_for_date(date, session)
-
-            if (
-                stats is not None
-                and "downloads" in stats
-                and stats["downloads"] is not None
-            ):
-                downloads_per_day[date.isoformat()] = stats["downloads"]
-
-            if (
-                stats is not None
-                and "updates" in stats
-                and stats["updates"] is not None
-            ):
-                updates_per_day[date.isoformat()] = stats["updates"]
-
-            if (
-                stats is not None
-                and "delta_downloads" in stats
-                and stats["delta_downloads"] is not None
-            ):
-                delta_downloads_per_day[date.isoformat()] = stats["delta_downloads"]
-
-            if (
-                stats is not None
-                and "countries" in stats
-                and stats["countries"] is not None
-            ):
-                for country, downloads in stats["countries"].items():
-                    if country not in totals_country:
-                        totals_country[country] = 0
-                    totals_country[country] = totals_country[country] + downloads
-    return {
-        "countries": totals_country,
-        "downloads_per_day": downloads_per_day,
-        "updates_per_day": updates_per_day,
-        "delta_downloads_per_day": delta_downloads_per_day,
-        "downloads": sum(downloads_per_day.values()),
-        "number_of_apps": db.get_app_count(),
-    }
 
+def _is_app(app_id: str) -> bool:
+    return "/" not in app_id
 
-def _sort_key(
-    app_stats: Dict[str, List[int]], for_arches: Optional[List[str]] = None
-) -> int:
-    new_dls = 0
-    for arch, dls in app_stats.items():
-        if for_arches is not None and arch not in for_arches:
-            continue
-        new_dls += dls[2]
-    return new_dls
 
+def get_downloads_document(
+    app_id: str,
+) -> Optional[Tuple[Optional[str], Optional[str], bytes]]:
+    if not _is_app(app_id):
+        return None
+    return db.get_document(f"app_stats:{app_id}")
+
+
+class DownloadsMatrix:
+    """
+    Installs per app and day since FIRST_STATS_DATE, summed over arches, as an
+    app x day int32 matrix
+
+    Per-arch installs are only kept as an arch x app x day matrix of the last
+    ARCH_DAYS days, and as all-time totals per arch and app, which is all
+    the per-arch windows need. Window totals are sums over day slices.
+    """
+
+    def __init__(
+        self,
+        arches: List[str],
+        appids: List[str],
+        downloads: np.ndarray,
+        recent: np.ndarray,
+        arch_totals: np.ndarray,
+    ):
+        self.arches = arches
+        self.appids = appids
+        self.index = {appid: row for row, appid in enumerate(appids)}
+        self.downloads = downloads
+        self.recent = recent
+        self.arch_totals = arch_totals
+
+    @property
+    def days(self) -> int:
+        return self.downloads.shape[1]
+
+    @property
+    def recent_start(self) -> int:
+        return self.days - self.recent.shape[2]
+
+    def get_window(
+        self, sdate: datetime.date, edate: datetime.date, arch: Optional[str] = None
+    ) -> np.ndarray:
+        start = max((sdate - FIRST_STATS_DATE).days, 0)
+        end = min((edate - FIRST_STATS_DATE).days, self.days - 1)
+        if end < start or (arch is not None and arch not in self.arches):
+            return np.zeros(len(self.appids), dtype=np.int64)
+
+        if arch is None:
+            return self.downloads[:, start : end + 1].sum(axis=1, dtype=np.int64)
+
+        arch_row = self.arches.index(arch)
+        if start == 0 and end == self.days - 1:
+            return self.arch_totals[arch_row]
+        if start < self.recent_start:
+            raise ValueError(f"Per-arch installs are only kept for {ARCH_DAYS} days")
+
+        recent = self.recent[
+            arch_row, :, start - self.recent_start : end - self.recent_start + 1
+        ]
+        return recent.sum(axis=1, dtype=np.int64)
+
+    def get_popular(
+        self, sdate: datetime.date, edate: datetime.date, arch: Optional[str] = None
+    ) -> Dict[str, int]:
+        totals = self.get_window(sdate, edate, arch)
+        return {
+            self.appids[row]: int(totals[row]) for row in np.flatnonzero(totals > 0)
+        }
 
-def _is_app(app_id: str) -> bool:
-    return "/" not in app_id
+    def get_trending(self, edate: datetime.date) -> Dict[str, float]:
+        """
+        Ratio of the average daily installs in the TRENDING_RECENT_DAYS up to
+        edate to those in the TRENDING_BASELINE_DAYS before, for all apps
+        which grew
+        """
+        recent_sdate = edate - datetime.timedelta(days=TRENDING_RECENT_DAYS - 1)
+        baseline_edate = recent_sdate - datetime.timedelta(days=1)
+        baseline_sdate = recent_sdate - datetime.timedelta(days=TRENDING_BASELINE_DAYS)
+
+        recent = self.get_window(recent_sdate, edate) / TRENDING_RECENT_DAYS
+        baseline = (
+            self.get_window(baseline_sdate, baseline_edate) / TRENDING_BASELINE_DAYS
+        )
+        # Damping keeps apps going from one to a handful of installs at bay
+        score = (recent + TRENDING_DAMPING) / (baseline + TRENDING_DAMPING)
+        return {
+            self.appids[row]: float(score[row]) for row in np.flatnonzero(score > 1)
+        }
 
+    def get_series(
+        self,
+        resolution: str,
+        edate: datetime.date,
+        sdate: datetime.date = FIRST_STATS_DATE,
+    ) -> np.ndarray:
+        """
+        Installs per app in each resolution bucket from the one sdate falls
+        in up to and including edate, summed over arches
+        """
+        bucket_start = _get_bucket_start(_get_bucket(sdate, resolution), resolution)
+        first = max((bucket_start - FIRST_STATS_DATE).days, 0)
+        days = min((edate - FIRST_STATS_DATE).days + 1, self.days)
+        per_day = self.downloads[:, first:days]
+        if resolution == "day" or days <= first:
+            return per_day
+
+        buckets = [
+            _get_bucket(FIRST_STATS_DATE + datetime.timedelta(days=day), resolution)
+            for day in range(first, days)
+        ]
+        starts = [
+            day
+            for day in range(len(buckets))
+            if day == 0 or buckets[day - 1] != buckets[day]
+        ]
+        return np.add.reduceat(per_day, starts, axis=1)
+
+    def to_bytes(self) -> bytes:
+        with io.BytesIO() as buffer:
+            np.savez_compressed(
+                buffer,
+                arches=np.array(self.arches),
+                appids=np.array(self.appids),
+                downloads=self.downloads,
+                recent=self.recent,
+                arch_totals=self.arch_totals,
+            )
+            return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Optional["DownloadsMatrix"]:
+        with np.load(io.BytesIO(data)) as npz:
+            # Saved with all per-arch counts, or before they were kept at all,
+            # needs a full rebuild
+            if "recent" not in npz.files:
+                return None
+
+            return cls(
+                npz["arches"].tolist(),
+                npz["appids"].tolist(),
+                npz["downloads"],
+                npz["recent"],
+                npz["arch_totals"],
+            )
+
+
+def _grow(array: np.ndarray, axis: int, size: int) -> np.ndarray:
+    shape = list(array.shape)
+    shape[axis] = size
+    grown = np.zeros(shape, dtype=array.dtype)
+    grown[tuple(slice(0, n) for n in array.shape)] = array
+    return grown
+
+
+def _get_downloads_matrix() -> Optional[DownloadsMatrix]:
+    if data := db.redis_binary_conn.get(STATS_DOWNLOADS_KEY):
+        return DownloadsMatrix.from_bytes(data)
+
+    return None
+
+
+def _get_bucket(date: datetime.date, resolution: str) -> int:
+    if resolution == "week":
+        return (date - SERIES_FIRST_WEEK).days // 7
+    if resolution == "month":
+        return (date.year - FIRST_STATS_DATE.year) * 12 + (
+            date.month - FIRST_STATS_DATE.month
+        )
+
+    return (date - FIRST_STATS_DATE).days
+
+
+def _get_bucket_start(bucket: int, resolution: str) -> datetime.date:
+    if resolution == "week":
+        return SERIES_FIRST_WEEK + datetime.timedelta(weeks=bucket)
+    if resolution == "month":
+        year, month = divmod(FIRST_STATS_DATE.month - 1 + bucket, 12)
+        return datetime.date(FIRST_STATS_DATE.year + year, month + 1, 1)
+
+    return FIRST_STATS_DATE + datetime.timedelta(days=bucket)
+
+
+@db.cached
+def get_series_end() -> Optional[datetime.date]:
+    """
+    Last day of the per-app series in the published generation, which
+    moves on without any totals changing when no new installs are counted
+    """
+    if value := db.redis_conn.get(db.catalogue_key(SERIES_END_KEY)):
+        return datetime.date.fromisoformat(value)
+
+    return None
+
+
+def get_app_series(
+    appid: str,
+    resolution: str = "day",
+    sdate: Optional[datetime.date] = None,
+    edate: Optional[datetime.date] = None,
+) -> Dict[str, int]:
+    """
+    Installs of appid per resolution bucket within [sdate, edate], keyed by
+    the first day of each bucket
+
+    Series are stored as packed integers, so only the requested range is read
+    from Redis. Updates extend them in place, so reads stop at the published
+    generation's get_series_end(), and the week or month it falls in, which
+    an update may be adding days to, is summed up from the days.
+    """
+    series_end = get_series_end()
+    if series_end is None:
+        return {}
+
+    sdate = max(sdate or FIRST_STATS_DATE, FIRST_STATS_DATE)
+    edate = min(edate or series_end, series_end)
+    if edate < sdate:
+        return {}
+
+    start = _get_bucket(sdate, resolution)
+    end = _get_bucket(edate, resolution)
+    stored_end = end
+    last_days = None
+    if resolution != "day" and end == _get_bucket(series_end, resolution):
+        stored_end = end - 1
+        last_days = (
+            _get_bucket(
+                max(_get_bucket_start(end, resolution), FIRST_STATS_DATE), "day"
+            ),
+            _get_bucket(series_end, "day"),
+        )
+
+    itemsize = SERIES_DTYPE.itemsize
+    with db.redis_binary_conn.pipeline(transaction=False) as p:
+        # GETRANGE would read the whole value for an empty range from 0
+        if stored_end >= start:
+            p.getrange(
+                f"app_stats_series:{appid}:{resolution}",
+                start * itemsize,
+                (stored_end + 1) * itemsize - 1,
+            )
+        if last_days is not None:
+            p.getrange(
+                f"app_stats_series:{appid}:day",
+                last_days[0] * itemsize,
+                (last_days[1] + 1) * itemsize - 1,
+            )
+        data = p.execute()
 
-def get_downloads_by_ids(ids: List[str]):
-    result = defaultdict()
-    for app_id in ids:
-        if not _is_app(app_id):
-            continue
-        app_stats = db.get_json_key(f"app_stats:{app_id}")
-        if app_stats is None:
-            continue
-        result[app_id] = app_stats
-    return result
+    values = np.frombuffer(data[0], dtype=SERIES_DTYPE) if stored_end >= start else []
+    series = {
+        _get_bucket_start(start + int(i), resolution).isoformat(): int(values[i])
+        for i in np.flatnonzero(values)
+    }
+    if last_days is not None:
+        if last := int(np.frombuffer(data[-1], dtype=SERIES_DTYPE).sum()):
+            series[_get_bucket_start(end, resolution).isoformat()] = last
 
+    return series
 
-def get_popular(days: Optional[int]):
-    edate = datetime.date.today()
 
+def _get_popular_window(days: Optional[int]) -> str:
     if days is None:
-        sdate = FIRST_STATS_DATE
-    else:
-        sdate = edate - datetime.timedelta(days=days - 1)
+        return "all"
+
+    # Snap to the nearest precomputed window
+    return str(min(POPULAR_WINDOWS, key=lambda window: abs(window - days)))
+
 
-    redis_key = f"popular:{sdate}-{edate}"
+def _get_popular_key(days: Optional[int], arch: Optional[str] = None) -> str:
+    window = _get_popular_window(days)
+    if arch is None:
+        return f"popular_zset:{window}"
 
-    if popular := db.get_json_key(redis_key):
-        return popular
+    return f"popular_zset:{window}:{arch}"
 
-    stats = _get_stats_for_period(sdate, edate)
-    sorted_apps = sorted(
-        filter(lambda a: _is_app(a[0]), stats.items()),
-        key=lambda a: _sort_key(a[1]),
-        reverse=True,
+
+def _zrevrange_page(redis_key: str, offset: int, limit: Optional[int]) -> List[str]:
+    if offset < 0 or (limit is not None and limit <= 0):
+        return []
+
+    end = -1 if limit is None else offset + limit - 1
+    return db.redis_conn.zrevrange(redis_key, offset, end)
+
+
+@db.cached
+def get_popular(
+    days: Optional[int],
+    offset: int = 0,
+    limit: Optional[int] = None,
+    arch: Optional[str] = None,
+):
+    return _zrevrange_page(
+        db.catalogue_key(_get_popular_key(days, arch)), offset, limit
     )
 
-    popular = [k for k, v in sorted_apps]
-    db.redis_conn.set(redis_key, json.dumps(popular), ex=60 * 60)
-    return popular
 
+def get_popular_document_key(days: Optional[int]) -> str:
+    """
+    Key of the stored JSON document listing all apps for get_popular(days)
+    """
+    return f"popular:{_get_popular_window(days)}"
 
-def update():
-    stats_apps_dict = defaultdict(lambda: {})
 
-    edate = datetime.date.today()
-    sdate = datetime.date(2018, 4, 29)
+@db.cached
+def get_trending(offset: int = 0, limit: Optional[int] = None):
+    return _zrevrange_page(db.catalogue_key("trending_zset"), offset, limit)
 
-    stats_total = _get_stats_for_period(sdate, edate)
-    stats_dict = _get_stats()
 
-    app_stats_per_day = _get_app_stats_per_day()
+@db.cached
+def get_sorted_by_downloads(
+    index_name: str, offset: int = 0, limit: Optional[int] = None
+) -> List[str]:
+    """
+    Members of the catalogue's apps:{id} set index_name, most downloaded in
+    the last month first
 
-    for appid, dict in stats_total.items():
-        if _is_app(appid):
-            # Index 0 is install and update count index 1 would be the update count
-            # Index 2 is the install count
-            stats_apps_dict[appid]["downloads_total"] = sum(
-                [i[2] for i in dict.values()]
-            )
+    The intersection with the downloads zset is cached in the published
+    generation, so a page is a single ZREVRANGE until the next update.
+    """
+    if offset < 0 or (limit is not None and limit <= 0):
+        return []
 
-            if appid in app_stats_per_day:
-                stats_apps_dict[appid]["downloads_per_day"] = app_stats_per_day[appid]
+    end = -1 if limit is None else offset + limit - 1
+    generation = db.get_generation()
+    index_key = db.generation_key(generation, index_name)
+    downloads_key = db.generation_key(generation, DOWNLOADS_ZSET_KEY)
+    sorted_key = db.generation_key(generation, f"downloads_sorted:{index_name}")
 
-    sdate_30_days = edate - datetime.timedelta(days=30 - 1)
-    stats_30_days = _get_stats_for_period(sdate_30_days, edate)
+    with db.redis_conn.pipeline(transaction=False) as p:
+        p.exists(sorted_key)
+        p.zrevrange(sorted_key, offset, end)
+        exists, ids = p.execute()
 
-    for appid, dict in stats_30_days.items():
-        if _is_app(appid):
-            # Index 0 is install and update count index 1 would be the update count
-            # Index 2 is the install count
-            stats_apps_dict[appid]["downloads_last_month"] = sum(
-                [i[2] for i in dict.values()]
-            )
+    if not exists:
+        with db.redis_conn.pipeline() as p:
+            p.zinterstore(sorted_key, {index_key: 0, downloads_key: 1})
+            p.zrevrange(sorted_key, offset, end)
+            ids = p.execute()[-1]
 
-    sdate_7_days = edate - datetime.timedelta(days=7 - 1)
-    stats_7_days = _get_stats_for_period(sdate_7_days, edate)
+    return [appid.removeprefix("apps:") for appid in ids]
 
-    for appid, dict in stats_7_days.items():
-        if _is_app(appid):
-            # Index 0 is install and update count index 1 would be the update count
-            # Index 2 is the install count
-            stats_apps_dict[appid]["downloads_last_7_days"] = sum(
-                [i[2] for i in dict.values()]
+
+def _new_stats_state() -> dict:
+    return {
+        "date": None,
+        "missing": [],
+        "refs": {},
+        "downloads_per_day": {},
+        "updates_per_day": {},
+        "delta_downloads_per_day": {},
+        "countries": {},
+    }
+
+
+class StatsAggregator:
+    """
+    Streaming aggregation of the daily flathub-stats documents
+
+    Every day is added exactly once, and all of the documents written by
+    update() are derived from that single visit. Finalized days are folded
+    into a state which can be persisted together with the downloads matrix
+    and passed back in to resume from its watermark; the last two days are
+    kept apart as flathub-stats keeps updating them. Finalized days which
+    flathub-stats did not have yet are listed in the state's "missing" and
+    retried by every later update, see missing_dates().
+    """
+
+    def __init__(
+        self,
+        edate: datetime.date,
+        state: Optional[dict] = None,
+        downloads: Optional[DownloadsMatrix] = None,
+    ):
+        self.edate = edate
+        # Skip last two days as flathub-stats publishes partial statistics
+        self.final_edate = edate - datetime.timedelta(days=stats_cache.FINAL_AFTER_DAYS)
+        self.state = state or _new_stats_state()
+        # Persisted before missing days were tracked
+        self.state.setdefault("missing", [])
+        self.partial = _new_stats_state()
+        # Earliest finalized day added, whatever the watermark it resumed from
+        self.first_final_date = None
+
+        self.days = (edate - FIRST_STATS_DATE).days + 1
+        self.recent_start = max(self.days - ARCH_DAYS, 0)
+
+        if downloads is not None and self.state["date"] is not None:
+            self.arches = list(downloads.arches)
+            self.appids = list(downloads.appids)
+        else:
+            self.state = _new_stats_state()
+            self.arches = []
+            self.appids = []
+        self.arch_index = {arch: i for i, arch in enumerate(self.arches)}
+        self.index = {appid: row for row, appid in enumerate(self.appids)}
+
+        # Rows are allocated ahead and doubled as apps show up
+        capacity = max(len(self.appids), 1024)
+        self.downloads = np.zeros((capacity, self.days), dtype=np.int32)
+        self.recent = np.zeros(
+            (len(self.arches), capacity, self.days - self.recent_start),
+            dtype=np.int32,
+        )
+
+        if self.appids:
+            # Drop the partial days the matrix was saved with
+            final_days = min((self.start_date() - FIRST_STATS_DATE).days, self.days)
+            apps = len(self.appids)
+            self.downloads[:apps, :final_days] = downloads.downloads[:, :final_days]
+
+            start = max(self.recent_start, downloads.recent_start)
+            for day in range(start, final_days):
+                self.recent[:, :apps, day - self.recent_start] = downloads.recent[
+                    :, :, day - downloads.recent_start
+                ]
+
+        self.matrix = None
+
+    def start_date(self) -> datetime.date:
+        if self.state["date"] is None:
+            return FIRST_STATS_DATE
+
+        return datetime.date.fromisoformat(self.state["date"]) + datetime.timedelta(
+            days=1
+        )
+
+    def missing_dates(self) -> List[datetime.date]:
+        return [datetime.date.fromisoformat(day) for day in self.state["missing"]]
+
+    def add(self, date: datetime.date, stats: Optional[dict]):
+        if date > self.final_edate:
+            if stats is not None:
+                self._fold(self.partial, date, stats)
+            return
+
+        day = date.isoformat()
+        missing = self.state["missing"]
+        if stats is None:
+            if day not in missing:
+                missing.append(day)
+                missing.sort()
+        else:
+            if day in missing:
+                missing.remove(day)
+            self._fold(self.state, date, stats)
+            if self.first_final_date is None or date < self.first_final_date:
+                self.first_final_date = date
+
+        # Missing days are retried apart from the watermark, which only
+        # ever moves forward
+        if self.state["date"] is None or day > self.state["date"]:
+            self.state["date"] = day
+
+    def _fold(self, state: dict, date: datetime.date, stats: dict):
+        day = date.isoformat()
+        for key in ("downloads", "updates", "delta_downloads"):
+            if stats.get(key) is not None:
+                state[f"{key}_per_day"][day] = stats[key]
+
+        if stats.get("countries") is not None:
+            countries = state["countries"]
+            for country, downloads in stats["countries"].items():
+                countries[country] = countries.get(country, 0) + downloads
+
+        if stats.get("refs") is None:
+            return
+
+        arches, rows, values = [], [], []
+        for app_id, app_stats in stats["refs"].items():
+            if not _is_app(app_id):
+                continue
+
+            if app_id not in self.index:
+                self._add_app(app_id)
+
+            app_totals = state["refs"].setdefault(app_id, {})
+            for arch, downloads in app_stats.items():
+                if arch not in app_totals:
+                    app_totals[arch] = [0, 0, 0]
+                app_totals[arch][0] += downloads[0]
+                app_totals[arch][1] += downloads[1]
+                app_totals[arch][2] += downloads[0] - downloads[1]
+
+                if arch not in self.arch_index:
+                    self._add_arch(arch)
+                arches.append(self.arch_index[arch])
+                rows.append(self.index[app_id])
+                values.append(downloads[0] - downloads[1])
+
+        if not values:
+            return
+
+        # Written a day at a time, so a full rebuild never holds more than a
+        # day's worth of counts in Python objects
+        day = (date - FIRST_STATS_DATE).days
+        np.add.at(self.downloads[:, day], rows, values)
+        if day >= self.recent_start:
+            np.add.at(
+                self.recent[:, :, day - self.recent_start], (arches, rows), values
+            )
+
+    def _add_app(self, app_id: str):
+        row = len(self.appids)
+        if row == self.downloads.shape[0]:
+            self.downloads = _grow(self.downloads, 0, row * 2)
+            self.recent = _grow(self.recent, 1, row * 2)
+
+        self.index[app_id] = row
+        self.appids.append(app_id)
+
+    def _add_arch(self, arch: str):
+        self.arch_index[arch] = len(self.arches)
+        self.arches.append(arch)
+        self.recent = _grow(self.recent, 0, len(self.arches))
+
+    def get_downloads(self) -> DownloadsMatrix:
+        if self.matrix is None:
+            apps = len(self.appids)
+
+            # All-time per-arch installs are the totals kept in the states
+            arch_totals = np.zeros((len(self.arches), apps), dtype=np.int64)
+            for state in (self.state, self.partial):
+                for appid, app_totals in state["refs"].items():
+                    for arch, downloads in app_totals.items():
+                        arch_totals[
+                            self.arch_index[arch], self.index[appid]
+                        ] += downloads[2]
+
+            self.matrix = DownloadsMatrix(
+                self.arches,
+                self.appids,
+                self.downloads[:apps],
+                self.recent[:, :apps],
+                arch_totals,
             )
 
-    db.redis_conn.set("stats", json.dumps(stats_dict))
-    db.redis_conn.mset(
-        {
-            f"app_stats:{appid}": json.dumps(stats_apps_dict[appid])
-            for appid in stats_apps_dict
+        return self.matrix
+
+    def get_stats(self, number_of_apps: int) -> dict:
+        state, partial = self.state, self.partial
+
+        countries = state["countries"].copy()
+        for country, downloads in partial["countries"].items():
+            countries[country] = countries.get(country, 0) + downloads
+
+        downloads_per_day = {
+            **state["downloads_per_day"],
+            **partial["downloads_per_day"],
+        }
+        return {
+            "countries": countries,
+            "downloads_per_day": downloads_per_day,
+            "updates_per_day": {
+                **state["updates_per_day"],
+                **partial["updates_per_day"],
+            },
+            "delta_downloads_per_day": {
+                **state["delta_downloads_per_day"],
+                **partial["delta_downloads_per_day"],
+            },
+            "downloads": sum(downloads_per_day.values()),
+            "number_of_apps": number_of_apps,
+        }
+
+    def get_app_stats(self) -> Dict[str, dict]:
+        state, partial = self.state, self.partial
+        downloads = self.get_downloads()
+
+        windows = {
+            "downloads_last_month": self.edate - datetime.timedelta(days=30 - 1),
+            "downloads_last_7_days": self.edate - datetime.timedelta(days=7 - 1),
         }
+        totals = {
+            arch: {
+                field: downloads.get_window(sdate, self.edate, arch)
+                for field, sdate in windows.items()
+            }
+            for arch in (None, *downloads.arches)
+        }
+
+        stats_apps_dict = {}
+        for appid in state["refs"].keys() | partial["refs"].keys():
+            # Index 2 is the install count
+            downloads_per_arch = defaultdict(int)
+            for app_totals in (state["refs"].get(appid), partial["refs"].get(appid)):
+                if app_totals is not None:
+                    for arch, dls in app_totals.items():
+                        downloads_per_arch[arch] += dls[2]
+
+            app_stats = {"downloads_total": sum(downloads_per_arch.values())}
+
+            row = downloads.index[appid]
+            for field, window in totals[None].items():
+                app_stats[field] = int(window[row])
+
+            app_stats["arches"] = {}
+            for arch, downloads_total in sorted(downloads_per_arch.items()):
+                app_stats["arches"][arch] = {"downloads_total": downloads_total}
+                for field, window in totals[arch].items():
+                    app_stats["arches"][arch][field] = int(window[row])
+
+            stats_apps_dict[appid] = app_stats
+
+        return stats_apps_dict
+
+
+def aggregate(
+    edate: datetime.date,
+    state: Optional[dict] = None,
+    downloads: Optional[DownloadsMatrix] = None,
+) -> StatsAggregator:
+    aggregator = StatsAggregator(edate, state, downloads)
+    dates = itertools.chain(
+        aggregator.missing_dates(), _date_range(aggregator.start_date(), edate)
     )
+    for date, stats in _iter_stats_for_dates(dates):
+        aggregator.add(date, stats)
+
+    return aggregator
+
+
+def update(generation: db.Generation, incremental: bool = True):
+    state, downloads = None, None
+    if incremental:
+        state = db.get_json_key(STATS_STATE_KEY)
+        downloads = _get_downloads_matrix()
+
+    aggregator = aggregate(datetime.date.today(), state, downloads)
+    downloads = aggregator.get_downloads()
+
+    db.redis_binary_conn.set(STATS_DOWNLOADS_KEY, downloads.to_bytes())
+    db.redis_conn.set(STATS_STATE_KEY, json.dumps(aggregator.state))
+
+    downloads_last_month = downloads.get_window(
+        aggregator.edate - datetime.timedelta(days=30 - 1), aggregator.edate
+    )
+    # Apps without any downloads need to be in the zset too, otherwise they
+    # would drop out of the category and developer intersections
+    downloads_zset = {}
+    for redis_key in db.redis_conn.smembers(generation.key("apps:index")):
+        appid = redis_key.removeprefix("apps:")
+        if (row := downloads.index.get(appid)) is not None:
+            downloads_zset[redis_key] = int(downloads_last_month[row])
+        else:
+            downloads_zset[redis_key] = 0
+
+    with db.BatchWriter("stats") as p:
+        p.replace_zset(generation.key(DOWNLOADS_ZSET_KEY), downloads_zset)
+
+        for days, arch in itertools.product(
+            (*POPULAR_WINDOWS, None), (None, *downloads.arches)
+        ):
+            if days is None:
+                sdate = FIRST_STATS_DATE
+            else:
+                sdate = aggregator.edate - datetime.timedelta(days=days - 1)
+
+            popular = downloads.get_popular(sdate, aggregator.edate, arch)
+            p.replace_zset(generation.key(_get_popular_key(days, arch)), popular)
+
+            # The full all-arches listing is also stored ready to be served,
+            # in ZREVRANGE order
+            if arch is None:
+                ids = sorted(popular, key=lambda appid: (popular[appid], appid))
+                generation.set_document(
+                    p,
+                    f"popular:{_get_popular_window(days)}",
+                    json.dumps(ids[::-1]),
+                    quality=db.BROTLI_QUALITY_MAX,
+                )
+
+        p.replace_zset(
+            generation.key("trending_zset"),
+            downloads.get_trending(aggregator.final_edate),
+        )
+
+        p.set(generation.key(SERIES_END_KEY), aggregator.final_edate.isoformat())
+
+        number_of_apps = db.redis_conn.scard(generation.key("apps:index"))
+        generation.set_document(
+            p, "stats", json.dumps(aggregator.get_stats(number_of_apps))
+        )
+        for appid, app_stats in aggregator.get_app_stats().items():
+            # Served with the requested series appended, never as stored
+            generation.set_document(
+                p, f"app_stats:{appid}", json.dumps(app_stats), compress=False
+            )
+
+    _update_series(generation, aggregator)
+
+
+def _update_series(generation: db.Generation, aggregator: StatsAggregator):
+    """
+    Write the per-app series of the apps in the generation's catalogue
+
+    The series of apps which were already in the previous generation are
+    complete up to its series end, only their buckets from the first day
+    added by this update on are overwritten, see get_app_series() for how
+    readers of the previous generation stay clear of them. Those of other
+    apps are written whole.
+    """
+    downloads = aggregator.get_downloads()
+    edate = aggregator.final_edate
+
+    previous_apps = set()
+    if db.redis_conn.exists(generation.previous_key(SERIES_END_KEY)):
+        previous_apps = db.redis_conn.smembers(generation.previous_key("apps:index"))
+
+    rows = {}
+    for redis_key in db.redis_conn.smembers(generation.key("apps:index")):
+        if (row := downloads.index.get(redis_key.removeprefix("apps:"))) is not None:
+            rows[redis_key] = row
+
+    itemsize = SERIES_DTYPE.itemsize
+    with db.BatchWriter("stats series", db.redis_binary_conn) as p:
+        for resolution in SERIES_RESOLUTIONS:
+            new = None
+            if aggregator.first_final_date is not None:
+                start = _get_bucket(aggregator.first_final_date, resolution)
+                new = downloads.get_series(
+                    resolution, edate, aggregator.first_final_date
+                )
+
+            whole = None
+            for redis_key, row in rows.items():
+                key = f"app_stats_series:{redis_key.removeprefix('apps:')}:{resolution}"
+                if redis_key in previous_apps:
+                    # Buckets past the stored ones are implicitly zero
+                    if new is not None and new[row].any():
+                        p.setrange(
+                            key,
+                            start * itemsize,
+                            new[row].astype(SERIES_DTYPE).tobytes(),
+                        )
+                else:
+                    if whole is None:
+                        whole = downloads.get_series(resolution, edate)
+                    p.set(key, whole[row].astype(SERIES_DTYPE).tobytes())
@@ -0,0 +1,115 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import re
+import tempfile
+from typing import Optional
+
+from . import config, utils
+
+# flathub-stats keeps rewriting the last two days, anything older is final
+FINAL_AFTER_DAYS = 2
+
+
+def is_final(date: datetime.date) -> bool:
+    return date <= datetime.date.today() - datetime.timedelta(days=FINAL_AFTER_DAYS)
+
+
+def _object_path(digest: str) -> str:
+    return os.path.join(
+        config.settings.stats_cache_dir, "objects", digest[:2], f"{digest[2:]}.gz"
+    )
+
+
+def _date_path(date: datetime.date) -> str:
+    return os.path.join(
+        config.settings.stats_cache_dir, "dates", date.strftime("%Y/%m/%d")
+    )
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def get(date: datetime.date) -> Optional[dict]:
+    try:
+        with open(_date_path(date), "r") as date_file:
+            digest = date_file.read().strip()
+        with open(_object_path(digest), "rb") as object_file:
+            data = gzip.decompress(object_file.read())
+    except FileNotFoundError:
+        return None
+
+    hasher = utils.Hasher()
+    hasher.add_bytes(data)
+    if hasher.hash() != digest:
+        return None
+
+    return json.loads(data)
+
+
+def put(date: datetime.date, data: bytes):
+    """
+    Store the raw stats document of a finalized day
+
+    Documents are stored gzip-compressed under the SHA-256 of their content,
+    the per-date entry only records which object belongs to the day.
+    """
+    hasher = utils.Hasher()
+    hasher.add_bytes(data)
+    digest = hasher.hash()
+
+    object_path = _object_path(digest)
+    if not os.path.exists(object_path):
+        _write_atomic(object_path, gzip.compress(data))
+    _write_atomic(_date_path(date), digest.encode("utf-8"))
+
+
+def seed(path: str) -> int:
+    """
+    Populate the cache from a local copy of flathub.org/stats, laid out as
+    YYYY/MM/DD.json
+    """
+    seeded = 0
+    date_re = re.compile(r"(\d{4})/(\d{2})/(\d{2})\.json$")
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            match = date_re.search(file_path.replace(os.sep, "/"))
+            if match is None:
+                continue
+
+            date = datetime.date(*[int(group) for group in match.groups()])
+            if not is_final(date):
+                continue
+
+            with open(file_path, "rb") as stats_file:
+                data = stats_file.read()
+
+            # Decode JSON to ensure it's not malformed
+            json.loads(data)
+
+            put(date, data)
+            seeded += 1
+
+    return seeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pre-seed the stats cache from a directory of JSON files"
+    )
+    parser.add_argument("path", help="directory laid out as YYYY/MM/DD.json")
+    args = parser.parse_args()
+
+    print(f"Seeded {seed(args.path)} days into {config.settings.stats_cache_dir}")
@@ -9,7 +9,10 @@ gi.require_version("OSTree", "1.0")
 
 from gi.repository import Gio, GLib, OSTree
 
-from . import config, db
+from . import config, db, utils
+
+# Checksum of the last summary processed
+SOURCE_KEY = "sources:summary"
 
 
 # "valid" here means it would be displayed on flathub.org
@@ -91,7 +94,17 @@ def parse_metadata(ini: str):
     return metadata
 
 
-def update():
+def update(generation: db.Generation, force: bool = False):
+    """
+    Store per-app metadata from the remote's OSTree summary
+
+    OSTree keeps its own copy of the summary and only refetches it when the
+    server's ETag/Last-Modified changed, so an unchanged summary is detected
+    by checksum and skipped, returning None.
+
+    recently_updated_zset is carried over from the previous generation and
+    updated with the summary's commit timestamps.
+    """
     summary_dict = defaultdict(lambda: {"arches": []})
     recently_updated_zset = {}
 
@@ -100,6 +113,15 @@ def update():
     repo.open(None)
 
     status, summary, signatures = repo.remote_fetch_summary("flathub", None)
+
+    hasher = utils.Hasher()
+    hasher.add_bytes(summary.get_data())
+    checksum = hasher.hash()
+    if not force and db.redis_conn.get(SOURCE_KEY) == checksum:
+        with db.BatchWriter("summary") as p:
+            generation.copy_zset(p, "recently_updated_zset")
+        return None
+
     data = GLib.Variant.new_from_bytes(
         GLib.VariantType.new(OSTree.SUMMARY_GVARIANT_STRING), summary, True
     )
@@ -150,10 +172,15 @@ def update():
 
         summary_dict[appid]["arches"].append(arch)
 
-    if recently_updated_zset:
-        db.redis_conn.zadd("recently_updated_zset", recently_updated_zset)
-    db.redis_conn.mset(
-        {f"summary:{appid}": json.dumps(summary_dict[appid]) for appid in summary_dict}
-    )
+    with db.BatchWriter("summary") as p:
+        generation.copy_zset(p, "recently_updated_zset")
+        if recently_updated_zset:
+            p.zadd(generation.key("recently_updated_zset"), recently_updated_zset)
+        # Most apps are unchanged between two summaries, their documents are
+        # not rewritten and recompressed
+        for appid, value in summary_dict.items():
+            generation.set_document(p, f"summary:{appid}", json.dumps(value))
+
+    generation.set_on_publish(SOURCE_KEY, checksum)
 
     return len(recently_updated_zset)
@@ -1,7 +1,11 @@
 import gzip
 import hashlib
+import itertools
 import json
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
 
 import requests
 from lxml import etree
@@ -31,7 +35,41 @@ class Hasher:
         return self.hasher.hexdigest()
 
 
-def appstream2dict(reponame: str):
+def _file_checksum(path: str) -> str:
+    hasher = Hasher()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            hasher.add_bytes(chunk)
+    return hasher.hash()
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    """
+    GzipFile which also closes what it reads from, as GzipFile leaves the
+    local file or streamed requests response it wraps open
+    """
+
+    def __init__(self, fileobj, source):
+        super().__init__(fileobj=fileobj)
+        self.source = source
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.source.close()
+
+
+def open_appstream(reponame: str, validators: Optional[dict] = None):
+    """
+    Open the repo's appstream unless it is unchanged since `validators`
+
+    Returns a tuple of the file (None when unchanged) and the validators
+    identifying this version of the source: ETag/Last-Modified for HTTP,
+    mtime/size/checksum for local paths.
+    """
+    validators = validators or {}
+
     if config.settings.appstream_repos is not None:
         appstream_path = os.path.join(
             config.settings.appstream_repos,
@@ -40,192 +78,282 @@ def appstream2dict(reponame: str):
             "x86_64",
             "appstream.xml",
         )
-        with open(appstream_path, "rb") as file:
-            if appstream_path.endswith(".gz"):
-                appstream = gzip.decompress(file.read())
-            else:
-                appstream = file.read()
+
+        stat = os.stat(appstream_path)
+        new_validators = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+        if all(validators.get(key) == new_validators[key] for key in new_validators):
+            return None, validators
+
+        # Touched but possibly identical, only a checksum can tell
+        new_validators["checksum"] = _file_checksum(appstream_path)
+        if validators.get("checksum") == new_validators["checksum"]:
+            return None, new_validators
+
+        file = open(appstream_path, "rb")
+        if appstream_path.endswith(".gz"):
+            return _ClosingGzipFile(file, file), new_validators
+        return file, new_validators
     else:
         appstream_url = (
             f"https://hub.flathub.org/{reponame}/appstream/x86_64/appstream.xml.gz"
         )
-        r = requests.get(appstream_url, stream=True)
-        appstream = gzip.decompress(r.raw.data)
-
-    root = etree.fromstring(appstream)
 
-    apps = {}
+        headers = {}
+        if etag := validators.get("etag"):
+            headers["If-None-Match"] = etag
+        if last_modified := validators.get("last_modified"):
+            headers["If-Modified-Since"] = last_modified
+
+        r = requests.get(appstream_url, stream=True, headers=headers)
+        if r.status_code == 304:
+            r.close()
+            return None, validators
+        try:
+            r.raise_for_status()
+        except requests.HTTPError:
+            r.close()
+            raise
+
+        new_validators = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+        return _ClosingGzipFile(r.raw, r), new_validators
+
+
+def component2dict(component):
+    app = {}
+
+    if component.attrib.get("type") != "desktop":
+        return None
+
+    descriptions = component.findall("description")
+    if len(descriptions):
+        for desc in descriptions:
+            component.remove(desc)
+            if len(desc.attrib) > 0:
+                continue
 
-    for component in root:
-        app = {}
+            description = [etree.tostring(tag, encoding=("unicode")) for tag in desc]
+            app["description"] = "".join(description)
+            break
 
-        if component.attrib.get("type") != "desktop":
-            continue
+    screenshots = component.find("screenshots")
+    if screenshots is not None:
+        app["screenshots"] = []
+        for screenshot in screenshots:
+            attrs = {}
 
-        descriptions = component.findall("description")
-        if len(descriptions):
-            for desc in descriptions:
-                component.remove(desc)
-                if len(desc.attrib) > 0:
-                    continue
+            for image in screenshot:
+                if image.attrib.get("type") == "thumbnail":
+                    width = image.attrib.get("width")
+                    height = image.attrib.get("height")
+                    attrs[f"{width}x{height}"] = image.text
 
+            if screenshot.attrib.get("type") == "default":
+                app["screenshots"].insert(0, attrs.copy())
+            else:
+                app["screenshots"].append(attrs.copy())
+        component.remove(screenshots)
+
+    releases = component.find("releases")
+    if releases is not None:
+        app["releases"] = []
+        for rel in releases:
+            attrs = {}
+            for attr in rel.attrib:
+                attrs[attr] = rel.attrib[attr]
+
+            desc = rel.find("description")
+            if desc is not None:
                 description = [
                     etree.tostring(tag, encoding=("unicode")) for tag in desc
                 ]
-                app["description"] = "".join(description)
-                break
-
-        screenshots = component.find("screenshots")
-        if screenshots is not None:
-            app["screenshots"] = []
-            for screenshot in screenshots:
-                attrs = {}
-
-                for image in screenshot:
-                    if image.attrib.get("type") == "thumbnail":
-                        width = image.attrib.get("width")
-                        height = image.attrib.get("height")
-                        attrs[f"{width}x{height}"] = image.text
-
-                if screenshot.attrib.get("type") == "default":
-                    app["screenshots"].insert(0, attrs.copy())
-                else:
-                    app["screenshots"].append(attrs.copy())
-            component.remove(screenshots)
-
-        releases = component.find("releases")
-        if releases is not None:
-            app["releases"] = []
-            for rel in releases:
-                attrs = {}
-                for attr in rel.attrib:
-                    attrs[attr] = rel.attrib[attr]
-
-                desc = rel.find("description")
-                if desc is not None:
-                    description = [
-                        etree.tostring(tag, encoding=("unicode")) for tag in desc
-                    ]
-                    attrs["description"] = "".join(description)
-
-                url = rel.find("url")
-                if url is not None:
-                    attrs["url"] = url.text
-
-                app["releases"].append(attrs.copy())
-            component.remove(releases)
-
-        content_rating = component.find("content_rating")
-        if content_rating is not None:
-            app["content_rating"] = {}
-            app["content_rating"]["type"] = content_rating.attrib.get("type")
-            for attr in content_rating:
-                attr_name = attr.attrib.get("id")
-                if attr_name:
-                    app["content_rating"][attr_name] = attr.text
-            component.remove(content_rating)
-
-        metadata = component.find("metadata")
-        if metadata is not None:
-            app["metadata"] = {}
-            for value in metadata:
-                key = value.attrib.get("key")
-                app["metadata"][key] = value.text
-            component.remove(metadata)
-
-        urls = component.findall("url")
-        if len(urls):
-            app["urls"] = {}
-            for url in urls:
-                component.remove(url)
-                url_type = url.attrib.get("type")
-                if url_type:
-                    app["urls"][url_type] = url.text
-
-        icons = component.findall("icon")
-        if len(icons):
-            icons_dict = {}
-
-            for icon in icons:
-                icon_type = icon.attrib.get("type")
-                icon_name = icon.text
-
-                icon_size = icon.attrib.get("width")
-                if icon_size:
-                    icon_size = int(icon_size)
-                else:
-                    icon_size = 0
-
-                if icon_type not in icons_dict:
-                    icons_dict[icon_type] = {}
-
-                icons_dict[icon_type][icon_size] = icon_name
-                component.remove(icon)
-
-            if icons_data := icons_dict.get("cached"):
-                cdn_baseurl = "https://dl.flathub.org"
-                icon_size = max(icons_data)
-                icon_name = icons_data[icon_size]
-                app[
-                    "icon"
-                ] = f"{cdn_baseurl}/repo/appstream/x86_64/icons/{icon_size}x{icon_size}/{icon_name}"
-            elif icons_data := icons_dict.get("remote"):
-                icon_size = max(icons_data)
-                app["icon"] = icons_data[icon_size]
-        else:
-            app["icon"] = None
-
-        for elem in component:
-            # TODO: support translations
-            if elem.attrib.get("{http://www.w3.org/XML/1998/namespace}lang"):
-                continue
-            if elem.tag == "languages":
-                continue
+                attrs["description"] = "".join(description)
+
+            url = rel.find("url")
+            if url is not None:
+                attrs["url"] = url.text
+
+            app["releases"].append(attrs.copy())
+        component.remove(releases)
+
+    content_rating = component.find("content_rating")
+    if content_rating is not None:
+        app["content_rating"] = {}
+        app["content_rating"]["type"] = content_rating.attrib.get("type")
+        for attr in content_rating:
+            attr_name = attr.attrib.get("id")
+            if attr_name:
+                app["content_rating"][attr_name] = attr.text
+        component.remove(content_rating)
+
+    metadata = component.find("metadata")
+    if metadata is not None:
+        app["metadata"] = {}
+        for value in metadata:
+            key = value.attrib.get("key")
+            app["metadata"][key] = value.text
+        component.remove(metadata)
+
+    urls = component.findall("url")
+    if len(urls):
+        app["urls"] = {}
+        for url in urls:
+            component.remove(url)
+            url_type = url.attrib.get("type")
+            if url_type:
+                app["urls"][url_type] = url.text
+
+    icons = component.findall("icon")
+    if len(icons):
+        icons_dict = {}
+
+        for icon in icons:
+            icon_type = icon.attrib.get("type")
+            icon_name = icon.text
+
+            icon_size = icon.attrib.get("width")
+            if icon_size:
+                icon_size = int(icon_size)
+            else:
+                icon_size = 0
+
+            if icon_type not in icons_dict:
+                icons_dict[icon_type] = {}
+
+            icons_dict[icon_type][icon_size] = icon_name
+            component.remove(icon)
+
+        if icons_data := icons_dict.get("cached"):
+            cdn_baseurl = "https://dl.flathub.org"
+            icon_size = max(icons_data)
+            icon_name = icons_data[icon_size]
+            app[
+                "icon"
+            ] = f"{cdn_baseurl}/repo/appstream/x86_64/icons/{icon_size}x{icon_size}/{icon_name}"
+        elif icons_data := icons_dict.get("remote"):
+            icon_size = max(icons_data)
+            app["icon"] = icons_data[icon_size]
+    else:
+        app["icon"] = None
 
-            if len(elem) == 0 and len(elem.attrib) == 0:
-                app[elem.tag] = elem.text
-
-            if len(elem) == 0 and len(elem.attrib):
-                attrs = {}
-                attrs["value"] = elem.text
-                for attr in elem.attrib:
-                    attrs[attr] = elem.attrib[attr]
-
-                if elem.tag not in app:
-                    siblings = component.findall(elem.tag)
-                    if len(siblings) > 1:
-                        app[elem.tag] = [attrs.copy()]
-                    else:
-                        app[elem.tag] = attrs
-                        continue
+    for elem in component:
+        # TODO: support translations
+        if elem.attrib.get("{http://www.w3.org/XML/1998/namespace}lang"):
+            continue
+        if elem.tag == "languages":
+            continue
+
+        if len(elem) == 0 and len(elem.attrib) == 0:
+            app[elem.tag] = elem.text
+
+        if len(elem) == 0 and len(elem.attrib):
+            attrs = {}
+            attrs["value"] = elem.text
+            for attr in elem.attrib:
+                attrs[attr] = elem.attrib[attr]
+
+            if elem.tag not in app:
+                siblings = component.findall(elem.tag)
+                if len(siblings) > 1:
+                    app[elem.tag] = [attrs.copy()]
                 else:
-                    app[elem.tag].append(attrs.copy())
+                    app[elem.tag] = attrs
+                    continue
+            else:
+                app[elem.tag].append(attrs.copy())
+
+        if len(elem):
+            app[elem.tag] = []
+            for tag in elem:
+                if not len(tag.attrib):
+                    app[elem.tag].append(tag.text)
+                    continue
+
+                # TODO: support translations
+                if tag.attrib.get("{http://www.w3.org/XML/1998/namespace}lang"):
+                    continue
+
+    # Settings seems to be a lonely, forgotten category with just 3 apps,
+    # add them to more popular System
+    if "categories" in app:
+        if "Settings" in app["categories"]:
+            app["categories"].append("System")
+
+    # Some apps keep .desktop suffix for legacy reasons, fall back to what
+    # Flatpak put into bundle component for actual ID
+    appid = app["bundle"]["value"].split("/")[1]
+    app["id"] = appid
+
+    return appid, app
 
-            if len(elem):
-                app[elem.tag] = []
-                for tag in elem:
-                    if not len(tag.attrib):
-                        app[elem.tag].append(tag.text)
-                        continue
 
-                    # TODO: support translations
-                    if tag.attrib.get("{http://www.w3.org/XML/1998/namespace}lang"):
-                        continue
+# Components handed to a parse worker at once
+PARSE_CHUNK_SIZE = 64
 
-        # Settings seems to be a lonely, forgotten category with just 3 apps,
-        # add them to more popular System
-        if "categories" in app:
-            if "Settings" in app["categories"]:
-                app["categories"].append("System")
 
-        # Some apps keep .desktop suffix for legacy reasons, fall back to what
-        # Flatpak put into bundle component for actual ID
-        appid = app["bundle"]["value"].split("/")[1]
-        app["id"] = appid
+def _parse_components(chunk: List[bytes]):
+    parsed = (component2dict(etree.fromstring(xml)) for xml in chunk)
+    return [item for item in parsed if item is not None]
 
-        apps[appid] = app
 
-    return apps
+def _iter_component_elements(file):
+    with file:
+        for _, component in etree.iterparse(file, tag="component"):
+            yield component
+
+            component.clear()
+            while component.getprevious() is not None:
+                del component.getparent()[0]
+
+
+def _iter_component_chunks(file):
+    chunk = []
+    for component in _iter_component_elements(file):
+        chunk.append(etree.tostring(component, with_tail=False))
+        if len(chunk) == PARSE_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_components(file, processes: Optional[int] = None):
+    """
+    Yield (appid, app) for every desktop component of an appstream file
+
+    The XML is decompressed and parsed incrementally and every component is
+    freed once converted, so memory use does not grow with the catalogue.
+
+    With more than one process, components are serialized in chunks and
+    converted by a process pool, results are still yielded in file order.
+    """
+    if processes is None:
+        processes = config.settings.appstream_parse_processes
+
+    if processes <= 1:
+        for component in _iter_component_elements(file):
+            if (parsed := component2dict(component)) is not None:
+                yield parsed
+        return
+
+    chunks = _iter_component_chunks(file)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque(
+            executor.submit(_parse_components, chunk)
+            for chunk in itertools.islice(chunks, 2 * processes)
+        )
+        while pending:
+            future = pending.popleft()
+            if next_chunk := next(chunks, None):
+                pending.append(executor.submit(_parse_components, next_chunk))
+            yield from future.result()
+
+
+def appstream2dict(reponame: str):
+    file, _ = open_appstream(reponame)
+    return dict(iter_components(file))
 
 
 def get_appids(path):
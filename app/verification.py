@@ -45,7 +45,7 @@ class ErrorDetail(str, Enum):
 
 
 def update():
-    with db.redis_conn.pipeline() as p:
+    with db.BatchWriter("verification") as p:
         with requests.Session() as session:
             for verdict in ["verified", "blocked"]:
                 r = session.get(
@@ -57,18 +57,15 @@ def update():
                     if len(value):
                         p.sadd(f"verification:{verdict}", *value)
 
-        p.execute()
-
 
 def initialize():
     verification_dir = os.path.join(config.settings.datadir, "verification")
-    with db.redis_conn.pipeline() as p:
+    with db.BatchWriter("verification") as p:
         for verdict in ["verified", "blocked"]:
             value = utils.get_appids(os.path.join(verification_dir, verdict + ".json"))
             p.unlink(f"verification:{verdict}")
             if len(value):
                 p.sadd(f"verification:{verdict}", *value)
-        p.execute()
 
 
 # Utility functions
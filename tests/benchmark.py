@@ -0,0 +1,106 @@
+"""
+Compare the CPU time spent per request on serving a stored JSON document by
+decoding and re-encoding it, as FastAPI does for returned objects, against
+passing the stored bytes through, and on compressing it per request, as
+compression middleware does, against serving the variants stored at ingest
+
+    python tests/benchmark.py [iterations]
+"""
+
+import gzip
+import json
+import os
+import sys
+import time
+
+import brotli
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from app import config, db, utils
+
+
+def reencode(value: bytes) -> bytes:
+    return JSONResponse(content=jsonable_encoder(json.loads(value))).body
+
+
+def passthrough(value: bytes) -> bytes:
+    return Response(content=value, media_type="application/json").body
+
+
+def gzip_on_the_fly(value: bytes) -> bytes:
+    # Starlette's GZipMiddleware default
+    return gzip.compress(value, compresslevel=9)
+
+
+def brotli_on_the_fly(value: bytes) -> bytes:
+    # The usual choice for brotli middleware, 11 is far too slow per request
+    return brotli.compress(value, quality=4)
+
+
+def measure(render, value: bytes, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        render(value)
+    return (time.process_time() - start) / iterations
+
+
+def get_documents():
+    config.settings.appstream_repos = os.path.join(ROOT_DIR, "tests", "appstream")
+    appstream = utils.appstream2dict("repo")
+
+    appid, app = max(appstream.items(), key=lambda item: len(json.dumps(item[1])))
+    yield appid, app
+
+    # Stand-in for apps with years of releases
+    long_history = dict(app, releases=app.get("releases", []) * 100)
+    yield f"{appid} (100x releases)", long_history
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    for name, document in get_documents():
+        value = json.dumps(document).encode()
+        assert json.loads(reencode(value)) == json.loads(passthrough(value))
+
+        reencode_time = measure(reencode, value, iterations)
+        passthrough_time = measure(passthrough, value, iterations)
+
+        print(f"{name}: {len(value)} bytes")
+        print(f"  decode and re-encode: {reencode_time * 1e6:10.1f} µs/request")
+        print(f"  passthrough:          {passthrough_time * 1e6:10.1f} µs/request")
+        print(
+            f"  saved:                {(reencode_time - passthrough_time) * 1e6:10.1f} µs/request"
+        )
+
+        # What set_document() stores
+        stored = {
+            "gzip": gzip.compress(value, compresslevel=9, mtime=0),
+            "br": brotli.compress(value, quality=db.BROTLI_QUALITY),
+        }
+        assert set(stored) == set(db.ENCODINGS)
+
+        for encoding, compress in (
+            ("gzip", gzip_on_the_fly),
+            ("br", brotli_on_the_fly),
+        ):
+            on_the_fly_time = measure(compress, value, iterations)
+            stored_time = measure(passthrough, stored[encoding], iterations)
+
+            print(f"  {encoding}:")
+            print(
+                f"    on the fly:         {on_the_fly_time * 1e6:10.1f} µs/request,"
+                f" {len(compress(value))} bytes"
+            )
+            print(
+                f"    precompressed:      {stored_time * 1e6:10.1f} µs/request,"
+                f" {len(stored[encoding])} bytes"
+            )
+
+
+if __name__ == "__main__":
+    main()
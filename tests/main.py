@@ -86,6 +86,44 @@ def test_update():
     assert response.status_code == 200
 
 
+def test_update_unchanged_appstream():
+    response = client.post("/update")
+    assert response.status_code == 200
+    assert response.json()["appstream"] == "unchanged"
+    assert response.json()["writes"]["stats"]["commands"] > 0
+
+    response = client.post("/update?force=true")
+    assert response.status_code == 200
+    assert response.json()["appstream"] == "updated"
+
+
+def test_update_publishes_new_generation():
+    from app import db
+
+    before = int(db.redis_conn.get(db.GENERATION_KEY))
+    categories = client.get("/category/Game").json()
+
+    response = client.post("/update")
+    assert response.status_code == 200
+
+    assert int(db.redis_conn.get(db.GENERATION_KEY)) > before
+    assert not db.redis_conn.exists(db.generation_key(before - 1, "apps:index"))
+    assert client.get("/category/Game").json() == categories
+
+
+def test_unpublished_generation_is_not_served():
+    from app import db
+
+    app = client.get("/appstream/org.sugarlabs.Maze").json()
+
+    generation = db.Generation()
+    with db.BatchWriter("test") as p:
+        generation.set_document(p, "apps:org.sugarlabs.Maze", json.dumps({}))
+
+    db.document_cache.clear()
+    assert client.get("/appstream/org.sugarlabs.Maze").json() == app
+
+
 def test_apps_by_category():
     response = client.get("/category/Game")
     assert response.status_code == 200
@@ -129,6 +167,39 @@ def test_appstream_by_appid():
     assert response.json() == _get_expected_json_result("test_appstream_by_appid")
 
 
+def test_appstream_by_appid_not_modified():
+    response = client.get("/appstream/org.sugarlabs.Maze")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/appstream/org.sugarlabs.Maze", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+
+def test_appstream_by_appid_precompressed():
+    response = client.get(
+        "/appstream/org.sugarlabs.Maze", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.json() == _get_expected_json_result("test_appstream_by_appid")
+
+
+def test_popular_not_modified():
+    response = client.get("/popular/7")
+    assert response.status_code == 200
+    assert "max-age" in response.headers["Cache-Control"]
+
+    response = client.get(
+        "/popular/7", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+
 def test_appstream_by_non_existent_appid():
     response = client.get("/appstream/NonExistent")
     assert response.status_code == 404
@@ -159,6 +230,46 @@ def test_search_query_by_description():
     assert response.json() == _get_expected_json_result("test_search_query_by_appid")
 
 
+def test_search_query_paging():
+    response = client.get("/search/Maze?offset=1&limit=10")
+    assert response.status_code == 200
+    assert response.json() == {"hits": [], "total": 1}
+
+    response = client.get("/search/Maze?limit=20000")
+    assert response.status_code == 200
+    assert response.json() == _get_expected_json_result("test_search_query_by_appid")
+
+    response = client.get("/search/Maze?limit=0")
+    assert response.status_code == 422
+
+
+def test_search_query_filters_and_facets():
+    response = client.get("/search/Maze?category=Game&facets=categories")
+    assert response.status_code == 200
+    result = response.json()
+    assert [hit["id"] for hit in result["hits"]] == ["org.sugarlabs.Maze"]
+    assert result["facets"] == {"categories": {"Game": 1}}
+
+    response = client.get("/search/Maze?developer_name=Sugar%20Labs%20Community")
+    assert response.status_code == 200
+    assert response.json()["total"] == 1
+
+    response = client.get("/search/Maze?category=Office")
+    assert response.status_code == 200
+    assert response.json() == _get_expected_json_result(
+        "test_search_query_by_non_existent"
+    )
+
+    response = client.get("/search/Maze?min_downloads=4999")
+    assert response.status_code == 422
+
+
+def test_search_suggest():
+    response = client.get("/search/suggest/maz")
+    assert response.status_code == 200
+    assert {"text": "Maze", "id": "org.sugarlabs.Maze"} in response.json()
+
+
 def test_search_query_by_non_existent():
     response = client.get("/search/NonExistent")
     assert response.status_code == 200
@@ -183,6 +294,22 @@ def test_collection_by_one_recently_updated():
     )
 
 
+def test_collection_by_trending():
+    response = client.get("/collection/trending")
+    assert response.status_code == 200
+    assert response.json() == [
+        "com.anydesk.Anydesk",
+        "com.wps.Office",
+        "org.sugarlabs.Maze",
+    ]
+
+
+def test_collection_by_trending_paged():
+    response = client.get("/collection/trending?offset=1&limit=1")
+    assert response.status_code == 200
+    assert response.json() == ["com.wps.Office"]
+
+
 def test_feed_by_recently_updated():
     response = client.get("/feed/recently-updated")
     assert response.status_code == 200
@@ -245,6 +372,30 @@ def test_popular():
     assert response.json() == _get_expected_json_result("test_popular")
 
 
+def test_popular_last_day():
+    response = client.get("/popular/1")
+    assert response.status_code == 200
+    assert response.json() == ["com.wps.Office", "com.anydesk.Anydesk"]
+
+
+def test_popular_paged():
+    response = client.get("/popular?offset=1&limit=1")
+    assert response.status_code == 200
+    assert response.json() == ["com.wps.Office"]
+
+
+def test_popular_by_arch():
+    response = client.get("/popular?arch=i386")
+    assert response.status_code == 200
+    assert response.json() == ["com.anydesk.Anydesk"]
+
+
+def test_popular_snaps_to_precomputed_window():
+    response = client.get("/popular/2")
+    assert response.status_code == 200
+    assert response.json() == client.get("/popular/1").json()
+
+
 def test_status():
     response = client.get("/status")
     assert response.status_code == 200
@@ -306,12 +457,237 @@ def test_app_stats_by_id():
         "downloads_per_day": {day_before_yesterday.isoformat(): 6},
         "downloads_last_month": 7,
         "downloads_last_7_days": 7,
+        "arches": {
+            "x86_64": {
+                "downloads_total": 7,
+                "downloads_last_month": 7,
+                "downloads_last_7_days": 7,
+            }
+        },
     }
 
     assert response.status_code == 200
     assert response.json() == expected
 
 
+def _walk_stats(sdate, edate):
+    import requests
+
+    from app import stats
+
+    with requests.Session() as session:
+        for i in range((edate - sdate).days + 1):
+            date = sdate + datetime.timedelta(days=i)
+            if (day_stats := stats._get_stats_for_date(date, session)) is not None:
+                yield date, day_stats
+
+
+def test_stats_aggregator_matches_full_walk():
+    from app import stats
+
+    today = datetime.date.today()
+    aggregator = stats.aggregate(today)
+
+    expected_stats = {
+        "countries": {},
+        "downloads_per_day": {},
+        "updates_per_day": {},
+        "delta_downloads_per_day": {},
+    }
+    for date, day_stats in _walk_stats(stats.FIRST_STATS_DATE, today):
+        for key in ("downloads", "updates", "delta_downloads"):
+            if day_stats.get(key) is not None:
+                expected_stats[f"{key}_per_day"][date.isoformat()] = day_stats[key]
+        for country, downloads in (day_stats.get("countries") or {}).items():
+            countries = expected_stats["countries"]
+            countries[country] = countries.get(country, 0) + downloads
+    expected_stats["downloads"] = sum(expected_stats["downloads_per_day"].values())
+    expected_stats["number_of_apps"] = 3
+
+    assert aggregator.get_stats(3) == expected_stats
+
+    expected = {}
+    for field, sdate in [
+        ("downloads_total", stats.FIRST_STATS_DATE),
+        ("downloads_last_month", today - datetime.timedelta(days=30 - 1)),
+        ("downloads_last_7_days", today - datetime.timedelta(days=7 - 1)),
+    ]:
+        for _, day_stats in _walk_stats(sdate, today):
+            for appid, app_stats in (day_stats.get("refs") or {}).items():
+                if "/" in appid:
+                    continue
+
+                expected_app = expected.setdefault(appid, {"arches": {}})
+                expected_app.setdefault(field, 0)
+                for arch, dls in app_stats.items():
+                    expected_app[field] += dls[0] - dls[1]
+                    expected_arch = expected_app["arches"].setdefault(arch, {})
+                    expected_arch[field] = expected_arch.get(field, 0) + dls[0] - dls[1]
+
+    assert aggregator.get_app_stats() == expected
+
+    # Series only cover finalized days
+    app_stats_per_day = {}
+    final_edate = today - datetime.timedelta(days=2)
+    for date, day_stats in _walk_stats(stats.FIRST_STATS_DATE, final_edate):
+        for appid, app_stats in (day_stats.get("refs") or {}).items():
+            if "/" not in appid:
+                app_stats_per_day.setdefault(appid, {})[date.isoformat()] = sum(
+                    dls[0] - dls[1] for dls in app_stats.values()
+                )
+
+    for appid, per_day in app_stats_per_day.items():
+        assert stats.get_app_series(appid) == per_day
+
+
+def test_stats_serial_fetch_matches_concurrent():
+    from app import config, stats
+
+    today = datetime.date.today()
+    concurrent = stats.aggregate(today)
+
+    concurrency = config.settings.stats_fetch_concurrency
+    config.settings.stats_fetch_concurrency = 1
+    try:
+        serial = stats.aggregate(today)
+    finally:
+        config.settings.stats_fetch_concurrency = concurrency
+
+    assert serial.state == concurrent.state
+    assert serial.get_app_stats() == concurrent.get_app_stats()
+
+
+def test_stats_missing_day_is_retried():
+    from app import stats
+
+    today = datetime.date.today()
+    date = today - datetime.timedelta(days=2)
+    stats_file = os.path.join(workspace.name, date.strftime("%Y/%m/%d.json"))
+    os.rename(stats_file, f"{stats_file}.hidden")
+    try:
+        aggregator = stats.aggregate(today)
+    finally:
+        os.rename(f"{stats_file}.hidden", stats_file)
+
+    assert aggregator.state["date"] == date.isoformat()
+    assert date.isoformat() in aggregator.state["missing"]
+
+    resumed = stats.aggregate(today, aggregator.state, aggregator.get_downloads())
+    full = stats.aggregate(today)
+    assert resumed.state == full.state
+    assert resumed.get_app_stats() == full.get_app_stats()
+
+
+def test_cache_invalidated_by_update():
+    from app import db
+
+    loads = []
+
+    @db.cached
+    def load(key):
+        loads.append(key)
+        return key
+
+    assert load("key") == "key"
+    assert load("key") == "key"
+    assert loads == ["key"]
+
+    response = client.post("/update")
+    assert response.status_code == 200
+
+    assert load("key") == "key"
+    assert loads == ["key", "key"]
+
+
+def test_cache_byte_budget():
+    from app import db
+
+    cache = db.VersionedCache(10, 60.0, max_bytes=10, weigh=len)
+    cache.get("a", lambda: b"12345")
+    cache.get("b", lambda: b"123456")
+    cache.get("c", lambda: b"12345678901")
+
+    # "a" was evicted to make room for "b", "c" is too large to be cached
+    assert list(cache.entries) == ["b"]
+    assert cache.get_stats()["bytes"] == 6
+
+
+def test_search_cache():
+    def get_search_stats():
+        response = client.get("/status/cache")
+        assert response.status_code == 200
+        return response.json()["search"]
+
+    client.post("/update")
+    before = get_search_stats()
+
+    first = client.get("/search/Maze")
+    second = client.get("/search/%20maze%20")
+    assert second.json() == first.json()
+
+    after = get_search_stats()
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+
+def test_appstream_parallel_parse_matches_serial():
+    from app import utils
+
+    file, _ = utils.open_appstream("repo")
+    serial = json.dumps(list(utils.iter_components(file, processes=1)))
+
+    file, _ = utils.open_appstream("repo")
+    parallel = json.dumps(list(utils.iter_components(file, processes=2)))
+
+    assert parallel == serial
+
+
+def test_stats_cache_seed():
+    from app import config, stats_cache
+
+    cache_dir = config.settings.stats_cache_dir
+    config.settings.stats_cache_dir = os.path.join(workspace.name, "cache")
+    try:
+        # Only the day before yesterday is final
+        assert stats_cache.seed(workspace.name) == 1
+
+        today = datetime.date.today()
+        day_before_yesterday = today - datetime.timedelta(days=2)
+        assert stats_cache.get(day_before_yesterday)["downloads"] == 703
+        assert stats_cache.get(today) is None
+    finally:
+        config.settings.stats_cache_dir = cache_dir
+
+
+def test_app_stats_after_incremental_update():
+    before = client.get("/stats/org.sugarlabs.Maze").json()
+
+    response = client.post("/update")
+    assert response.status_code == 200
+
+    response = client.get("/stats/org.sugarlabs.Maze")
+    assert response.status_code == 200
+    assert response.json() == before
+
+
+def test_app_stats_by_id_per_month():
+    today = datetime.date.today()
+    day_before_yesterday = today - datetime.timedelta(days=2)
+    month = day_before_yesterday.replace(day=1)
+
+    response = client.get(
+        f"/stats/org.sugarlabs.Maze?from={month.isoformat()}&resolution=month"
+    )
+    assert response.status_code == 200
+    assert response.json()["downloads_per_month"] == {month.isoformat(): 6}
+
+
+def test_app_stats_by_id_out_of_range():
+    response = client.get("/stats/org.sugarlabs.Maze?to=2018-01-01")
+    assert response.status_code == 200
+    assert "downloads_per_day" not in response.json()
+
+
 def test_app_stats_by_non_existent_id():
     response = client.get("/stats/does.not.exist")
     assert response.status_code == 404